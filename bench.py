@@ -0,0 +1,412 @@
+#!/usr/bin/python
+# benchmarks of ccl on synthetic registration data (see synth.py)
+#
+# Every result is also kept in _results, --json writes them to a file and --compare prints
+# the change against such a file, e.g. of the previous commit.
+import getopt, sys, os, tempfile, time, shutil, gc, subprocess, json
+from datetime import date
+from collections import OrderedDict, defaultdict
+import ccl, instrument, validate, history, dedupe, placement, podutil
+from ccl import *
+from synth import School, write_arrangement, write_open_arrangement
+
+def bench_startup(csvfile, nrows, tmpdir):
+    '''ccl.init from the csv file and from its cached snapshot'''
+    cache_dir = ccl.cache_dir
+    ccl.cache_dir = os.path.join(tmpdir, 'cache')
+    def cold():
+        ccl.reset()
+        if os.path.isdir(ccl.cache_dir): shutil.rmtree(ccl.cache_dir)
+        ccl.init(csvfile, cache=True)
+    def warm():
+        ccl.reset()
+        ccl.init(csvfile, cache=True)
+    try:
+        _report('ccl.init(cache=True) cold', _timeit(cold), nrows, 'row')
+        _report('ccl.init(cache=True) warm', _timeit(warm), nrows, 'row')
+    finally:
+        ccl.cache_dir = cache_dir
+
+def _rss():
+    '''return resident memory of this process in bytes (Linux)'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def _print_memory_per_student(csvfile):
+    gc.collect()
+    before = _rss()
+    ccl.init(csvfile)
+    gc.collect()
+    print '%d %d' % (len(ccl._students), _rss() - before)
+
+def bench_memory(tmpdir, seed, nfamilies=28000):
+    '''memory of the loaded tables of a registration file of about 50k rows, measured in a fresh process'''
+    csvfile = os.path.join(tmpdir, 'memory.csv')
+    with open(csvfile, 'wb') as fh:
+        School(nfamilies, seed).write_registration(fh)
+    out = subprocess.check_output([sys.executable, '-c', 'import bench; bench._print_memory_per_student(%r)' % csvfile],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    nstudents, nbytes = [int(x) for x in out.split()]
+    print '%-32s %10.1f MB  %10.0f bytes/student' % ('ccl.init memory (%d students)' % nstudents, nbytes/1e6, float(nbytes)/nstudents)
+    _record('ccl.init memory', bytes=nbytes, n=nstudents, unit='student')
+
+def bench_history(tmpdir, seed, nfamilies, nlines, nyears=5):
+    '''queries of a history store of nyears school years of synthetic registrations and duties'''
+    store = history.History(os.path.join(tmpdir, 'history'))
+    for y in range(nyears):
+        csvfile = os.path.join(tmpdir, 'history-%d.csv' % y)
+        cstfile = os.path.join(tmpdir, 'history-%d.cst' % y)
+        with open(csvfile, 'wb') as fh:
+            School(nfamilies, seed+y).write_registration(fh)
+        ccl.reset()
+        ccl.init(csvfile)
+        with open(cstfile, 'wt') as fh:
+            write_arrangement(fh, nlines, seed+y, first=date(2011+y, 9, 12))
+        store.add('%d-%d' % (2011+y, 2012+y), csvfile, cstfile)
+    nrows = sum(len(rows) for rows in store.students.itervalues())
+    _report('History() open', _timeit(lambda: history.History(store.path)), nrows, 'row')
+    store = history.History(store.path)
+    families = sorted(store.family_duties)[:1000]
+    _report('count_family_duties', _timeit(lambda: [store.count_family_duties(k) for k in families]), len(families), 'call')
+    n = len(store.duties(date(2013, 9, 1), date(2014, 8, 31)))
+    _report('duties of a year', _timeit(lambda: store.duties(date(2013, 9, 1), date(2014, 8, 31))), n, 'row')
+    ids = sorted(store.students)[:1000]
+    _report('student', _timeit(lambda: [store.student(id) for id in ids]), len(ids), 'call')
+
+def bench_columnar(tmpdir, seed, nfamilies=56000):
+    '''finance queries over a columnar view of about 100k registrations'''
+    import columnar
+    csvfile = os.path.join(tmpdir, 'history.csv')
+    with open(csvfile, 'wb') as fh:
+        nrows = School(nfamilies, seed).write_registration(fh)
+    ccl.reset()
+    ccl.init(csvfile)
+    cols = []
+    _report('StudentColumns()', _timeit(lambda: cols.append(columnar.StudentColumns()), repeat=1), nrows, 'row')
+    cols = cols[0]
+    _report('active AM students', _timeit(lambda: cols.count(cols.mask(active=1, session='AM'))), nrows, 'row')
+    _report('tuition by class', _timeit(lambda: cols.sum_by('cls', 'tuition', cols.mask(active=1))), nrows, 'row')
+    _report('pending checks by status', _timeit(lambda: cols.count_by('status', cols.mask(tuition_status='Pending'))), nrows, 'row')
+
+def _timeit(fn, repeat=3, setup=None):
+    '''return the best wall clock time of repeat runs of fn, fn is given the return value of setup if any'''
+    best = None
+    for i in range(repeat):
+        arg = setup() if setup else None
+        t0 = time.time()
+        if setup: fn(arg)
+        else: fn()
+        t = time.time() - t0
+        if best is None or t < best: best = t
+    return best
+
+_results = []   # [{name, ms, n, unit, ...}] of this run
+
+def _record(name, **values):
+    r = OrderedDict(name=name)
+    r.update(sorted(values.items()))
+    _results.append(r)
+
+def _report(name, secs, n, unit):
+    print '%-32s %10.3f ms  %10.3f us/%s' % (name, secs*1000, secs*1e6/max(n, 1), unit)
+    _record(name, ms=round(secs*1000, 3), n=n, unit=unit)
+
+def bench_init(csvfile, nrows):
+    def load():
+        ccl.reset()
+        ccl.init(csvfile)
+    def load_skipping():
+        ccl.reset()
+        ccl.init(csvfile, skip_errors=True)
+    def load_projected():
+        ccl.reset()
+        ccl.init(csvfile, needs=['culture'])
+    def parse_only():
+        for rec in iter_registration(csvfile): pass
+    _report('iter_registration', _timeit(parse_only), nrows, 'row')
+    _report('ccl.init', _timeit(load), nrows, 'row')
+    _report('ccl.init(skip_errors=True)', _timeit(load_skipping), nrows, 'row')
+    _report("ccl.init(needs=['culture'])", _timeit(load_projected), nrows, 'row')
+
+def bench_validate(nrows):
+    _report('validate (all rules)', _timeit(validate.validate), nrows, 'row')
+
+def bench_dedupe(nrows):
+    _report('dedupe.find_duplicates', _timeit(dedupe.find_duplicates), len(Parent.all()), 'family')
+
+def bench_placement(csvfile):
+    '''place again all the students with culture choices, into classes of 80% of the seats asked for'''
+    choices = placement.read_choices(csvfile)
+    first = defaultdict(int)
+    for names in choices.itervalues(): first[names[0]] += 1
+    capacities = OrderedDict((name, placement.Capacity(int(n*0.8), ['AM', 'PM', 'NOON'][i % 3]))
+                             for i, (name, n) in enumerate(sorted(first.iteritems())))
+    _report('placement.read_choices', _timeit(lambda: placement.read_choices(csvfile)), len(choices), 'student')
+    _report('placement.place', _timeit(lambda: placement.place(choices, capacities, replace=True)), len(choices), 'student')
+
+def bench_load(cstfile, nlines):
+    def load():
+        Arrangement().load(cstfile)
+    def find():
+        for s in students: Student.find(s.name)
+    def find_cls():
+        for s in students: Student.find(s.name, s.cls.name)
+    students = Student.all()
+    secs = _timeit(load)
+    _report('Arrangement.load', secs, nlines, 'line')
+    print '%-32s %10.0f lines/s' % ('Arrangement.load throughput', nlines/secs)
+    _report('Student.find(name)', _timeit(find), len(students), 'call')
+    _report('Student.find(name, classname)', _timeit(find_cls), len(students), 'call')
+
+def _init_fill_roster(tmpdir, seed, nfamilies=2850):
+    '''load a roster of about 5000 students for fill benchmarks, return # of students'''
+    csvfile = os.path.join(tmpdir, 'fill.csv')
+    with open(csvfile, 'wb') as fh:
+        nrows = School(nfamilies, seed).write_registration(fh)
+    ccl.reset()
+    ccl.init(csvfile)
+    return nrows
+
+def bench_fill(tmpdir, seed, ndates=60):
+    '''fill 60 dates of open duties from about 5000 students'''
+    nrows = _init_fill_roster(tmpdir, seed)
+    cstfile = os.path.join(tmpdir, 'fill.cst')
+    with open(cstfile, 'wt') as fh:
+        write_open_arrangement(fh, ndates)
+    def setup():
+        asgm = Arrangement()
+        asgm.load(cstfile)
+        return asgm
+    def fill(asgm):
+        if not asgm.fill_duties(after=date(2015, 9, 1)):
+            raise Exception('fill_duties failed')
+    print '# fill %d students over %d dates' % (nrows, ndates)
+    _report('Arrangement.fill_duties', _quiet(_timeit, fill, setup=setup), nrows, 'student')
+    instrument.enable()
+    try:
+        _report('fill_duties (instrumented)', _quiet(_timeit, fill, setup=setup), nrows, 'student')
+    finally:
+        instrument.enable(False)
+        instrument.reset()
+    asgm = setup()
+    _report('_collect_candidates (empty)', _timeit(asgm._collect_candidates), nrows, 'student')
+    _quiet(fill, asgm)
+    _report('_collect_candidates (filled)', _timeit(asgm._collect_candidates), nrows, 'student')
+    after = asgm.calendar.dates[len(asgm.calendar.dates)/2]
+    def summary():
+        with open(os.devnull, 'w') as fh:
+            podutil.write_summary(fh, asgm, after)
+    _report('Arrangement.score (2nd half)', _timeit(lambda: asgm.score(after)), len(asgm.duties), 'duty')
+    _report('podutil.write_summary (2nd half)', _timeit(summary), len(asgm.duties), 'duty')
+
+def bench_trials(tmpdir, seed, trials=8, ndates=60):
+    '''multi-seed fill with 1 worker and with one worker per core'''
+    import multiprocessing
+    nrows = _init_fill_roster(tmpdir, seed)
+    print '# %d trials on %d students over %d dates' % (trials, nrows, ndates)
+    cstfile = os.path.join(tmpdir, 'trials.cst')
+    with open(cstfile, 'wt') as fh:
+        write_open_arrangement(fh, ndates)
+    def setup():
+        asgm = Arrangement()
+        asgm.load(cstfile)
+        return asgm
+    ncpu = multiprocessing.cpu_count()
+    for workers in sorted(set([1, ncpu])):
+        def fill(asgm):
+            if not asgm.fill_duties(after=date(2015, 9, 1), seed=seed, trials=trials, workers=workers):
+                raise Exception('fill_duties failed')
+        _report('fill_duties(trials=%d, workers=%d)' % (trials, workers), _quiet(_timeit, fill, repeat=1, setup=setup), trials, 'trial')
+
+def _solver_scenarios(ndates):
+    '''return (AM bounds, PM bounds, PJ spots) of constraint files for comparing solvers,
+    relative to the average # of AM/PM candidates per date'''
+    avg = {'AM': 0.0, 'PM': 0.0}
+    for c in Arrangement()._collect_candidates():
+        avg[c.student.cls.ampm()] += 1.0/ndates
+    def bounds(lo, hi):
+        return ['%d,%d' % (max(0, int(avg[ampm]*lo)), int(avg[ampm]*hi+1)) for ampm in ['AM', 'PM']]
+    return [bounds(0, 10) + ['5'],          # loose
+            bounds(0.9, 1.0) + ['5'],       # every candidate fits
+            bounds(0.8, 0.9) + ['5'],       # no room for some parents' second duty
+            bounds(0.9, 1.0) + ['25'],      # PJ takes a lot from the pools
+            bounds(0.1, 0.3) + ['5']]       # no solution
+
+def bench_solvers(tmpdir, seed, trials=5, ndates=60):
+    '''compare success rate and runtime of greedy and flow fill_duties'''
+    nrows = _init_fill_roster(tmpdir, seed)
+    cstfile = os.path.join(tmpdir, 'solver.cst')
+    print '# solvers on %d students over %d dates, %d trials each' % (nrows, ndates, trials)
+    for am, pm, pj in _solver_scenarios(ndates):
+        with open(cstfile, 'wt') as fh:
+            write_open_arrangement(fh, ndates, am=am, pm=pm, pj=pj)
+        for solver in ['greedy', 'flow']:
+            ok, secs = 0, 0.0
+            for i in range(trials):
+                asgm = Arrangement()
+                asgm.load(cstfile)
+                t0 = time.time()
+                ok += _quiet(asgm.fill_duties, after=date(2015, 9, 1), solver=solver)
+                secs += time.time() - t0
+            print 'AM=%-8s PM=%-8s PJ=%-3s %-6s  %d/%d ok  %10.3f ms' % (am, pm, pj, solver, ok, trials, secs*1000/trials)
+            _record('%s AM=%s PM=%s PJ=%s' % (solver, am, pm, pj), ms=round(secs*1000/trials, 3), ok=ok, n=trials, unit='trial')
+
+def bench_reports(tmpdir, seed, nfamilies, ndates=60):
+    '''run each report of the command line tools from a warm cache, interpreter startup included'''
+    csvfile = os.path.join(tmpdir, 'reports.csv')
+    cstfile = os.path.join(tmpdir, 'reports.cst')
+    filled  = os.path.join(tmpdir, 'reports-filled.cst')
+    with open(csvfile, 'wb') as fh:
+        nrows = School(nfamilies, seed).write_registration(fh)
+    with open(cstfile, 'wt') as fh:
+        write_open_arrangement(fh, ndates)
+    out = os.path.join(tmpdir, 'report.out')
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, HOME=tmpdir)   # keep the snapshot cache in tmpdir
+    def tool(script, *args):
+        cmd = [sys.executable, os.path.join(here, script)] + list(args)
+        def run():
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(cmd, stdout=devnull, stderr=devnull, env=env)
+        return run
+    podutil = ['podutil.py', '--csv', csvfile, '--after', '2015-09-01']
+    tool(*podutil + ['--seed', str(seed), '--fill', filled, cstfile])()   # warms the cache too
+    reports = [('podutil --fill',          podutil + ['--seed', str(seed), '--fill', out, cstfile]),
+               ('podutil --post',          podutil + ['--post', out, filled]),
+               ('podutil --summary',       podutil + ['--summary', out, filled]),
+               ('classinfo language',      ['classinfo.py', '--csv', csvfile, '--class', 'language']),
+               ('classinfo culture',       ['classinfo.py', '--csv', csvfile, '--class', 'culture']),
+               ('classinfo all --format csv', ['classinfo.py', '--csv', csvfile, '--class', 'all', '--format', 'csv',
+                                               '--output', out]),
+               ('checkinfo B1A,B1P',       ['checkinfo.py', '--csv', csvfile, '--class', 'B1A,B1P']),
+               ('reports.py 4 reports',   ['reports.py', '--csv', csvfile, '--after', '2015-09-01',
+                                            '--roster', out, '--tuition', out+'.tuition', '--tuition-class', 'B1A,B1P',
+                                            '--post', out+'.post', '--summary', out+'.summary', filled])]
+    try:
+        import reportlab
+        reports.append( ('podutil --sign', podutil + ['--sign', out, filled]) )
+    except ImportError:
+        pass
+    print '# reports of %d registrations' % nrows
+    for name, cmd in reports:
+        _report(name, _timeit(tool(*cmd)), nrows, 'row')
+
+def compare(old, new, threshold=0.1):
+    '''print the results of new against old ([{name, ms, ...}]), marking changes over threshold'''
+    before = dict((r['name'], r) for r in old)
+    print '%-40s %12s %12s %8s' % ('# benchmark', 'before ms', 'after ms', 'change')
+    for r in new:
+        o = before.get(r['name'])
+        if o is None or 'ms' not in r or 'ms' not in o: continue
+        change = r['ms']/o['ms'] - 1 if o['ms'] else 0.0
+        mark = ' slower' if change > threshold else ' faster' if change < -threshold else ''
+        print '%-40s %12.3f %12.3f %+7.1f%%%s' % (r['name'], o['ms'], r['ms'], change*100, mark)
+
+def _git_head():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _quiet(fn, *args, **kwargs):
+    '''call fn with stderr discarded'''
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+_benches = ['init', 'startup', 'memory', 'columnar', 'history', 'load', 'validate', 'dedupe', 'placement', 'fill', 'solvers', 'trials', 'reports']
+
+def usage():
+    print \
+        '''%s [--families <# of families, default 11000>] [--lines <# of constraint lines, default 5000>] [--seed <random seed>]
+        [--bench <%s>] [--json <output>] [--compare <earlier json output>]
+        --bench,   comma separated benchmarks to run, default all
+        --json,    write the results and the git commit to this file
+        --compare, print the change of each timing against the results of an earlier --json''' % (sys.argv[0], '|'.join(_benches))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['families=', 'lines=', 'seed=', 'bench=', 'json=', 'compare=', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    nfamilies, nlines, seed, benches = 11000, 5000, 0, _benches
+    output = baseline = None
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--families':
+            nfamilies = int(v)
+        elif o == '--lines':
+            nlines = int(v)
+        elif o == '--seed':
+            seed = int(v)
+        elif o == '--bench':
+            benches = v.split(',')
+        elif o == '--json':
+            output = v
+        elif o == '--compare':
+            with open(v) as f:
+                baseline = json.load(f)['results']
+
+    tmpdir = tempfile.mkdtemp()
+    csvfile = os.path.join(tmpdir, 'registration.csv')
+    cstfile = os.path.join(tmpdir, 'arrangement.cst')
+    try:
+        with open(csvfile, 'wb') as fh:
+            nrows = School(nfamilies, seed).write_registration(fh)
+        print '# %d families, %d registrations' % (nfamilies, nrows)
+        if 'init' in benches:
+            bench_init(csvfile, nrows)
+        if 'startup' in benches:
+            bench_startup(csvfile, nrows, tmpdir)
+        if 'memory' in benches:
+            bench_memory(tmpdir, seed)
+        if 'columnar' in benches:
+            bench_columnar(tmpdir, seed)
+        if 'history' in benches:
+            bench_history(tmpdir, seed, nfamilies, nlines)
+
+        ccl.reset()
+        ccl.init(csvfile)
+        with open(cstfile, 'wt') as fh:
+            ncst = write_arrangement(fh, nlines, seed)
+        if 'load' in benches:
+            bench_load(cstfile, ncst)
+        if 'validate' in benches:
+            bench_validate(nrows)
+        if 'dedupe' in benches:
+            bench_dedupe(nrows)
+        if 'placement' in benches:
+            bench_placement(csvfile)
+        if 'fill' in benches:
+            bench_fill(tmpdir, seed)
+        if 'solvers' in benches:
+            bench_solvers(tmpdir, seed)
+        if 'trials' in benches:
+            bench_trials(tmpdir, seed)
+        if 'reports' in benches:
+            bench_reports(tmpdir, seed, nfamilies)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if output:
+        with open(output, 'wt') as f:
+            json.dump(OrderedDict([('commit', _git_head()), ('python', sys.version.split()[0]),
+                                   ('families', nfamilies), ('lines', nlines), ('seed', seed),
+                                   ('results', _results)]), f, indent=2)
+            f.write('\n')
+    if baseline is not None:
+        compare(baseline, _results)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 # must run in a command window
 # this version temporarily assign an 0 id to inactive students
-import sys, re, csv, re, random, math
+import sys, os, re, csv, re, random, math, json, heapq, bisect, hashlib, marshal, gc, copy, logging
 from datetime import date
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, namedtuple, defaultdict
+import instrument
+
+# progress and errors of the fills, silent unless the application configures logging
+_log = logging.getLogger('ccl')
+_log.addHandler(logging.NullHandler())
 
 def _proc_name(name):
     '''formalize name string, for example " Josh  Huang " ==> "Josh Huang"'''
@@ -24,19 +29,43 @@ _students = {}
 _parents  = {}
 _classes  = {}
 
+# Secondary indexes of the tables, maintained by add()/register()
+_students_by_name     = defaultdict(set)  # name ==> students
+_students_by_name_cls = {}                # (name, classname) ==> student
+_parents_by_name      = defaultdict(set)  # mom or dad name ==> parents
+
+# Children who may take POD duties, built on first use after a load, see _pod_families()
+_pod_children = OrderedDict()   # parent ==> active POD children sorted by ID
+_merges = 0   # # of Parent.merge() calls, a Tally counted by family before the last one is stale
+
+def reset():
+    '''clear all tables of CCL database'''
+    _students.clear()
+    _parents.clear()
+    _classes.clear()
+    _students_by_name.clear()
+    _students_by_name_cls.clear()
+    _parents_by_name.clear()
+    _pod_children.clear()
+
 def __ensure_init():
     if not __students or not __parents or not __classes:
         raise Exception('CCL database not initialized')
 
-class Parent:
+# shared by all parents without phone or email, replaced by a set on the first add
+_no_contacts = frozenset()
+
+class Parent(object):
+    __slots__ = ('mom', 'dad', 'key', 'phones', 'emails', 'children')
+
     def __init__(self, mom="", dad=""):
         self.mom = _proc_name(mom)
         self.dad = _proc_name(dad)
         if not self.mom and not self.dad:
             raise Exception('No Mom and Dad name')
         self.key = (self.mom, self.dad)
-        self.phones = set()
-        self.emails = set()
+        self.phones = _no_contacts
+        self.emails = _no_contacts
         self.children = set()
 
     def add_child(self, child):
@@ -46,11 +75,13 @@ class Parent:
     def add_phone(self, phone):
         phone = _proc_phone(phone);
         if not phone: return
+        if self.phones is _no_contacts: self.phones = set()
         self.phones.add(phone)
 
     def add_email(self, email):
         email = _proc_email(email);
         if not email: return
+        if self.emails is _no_contacts: self.emails = set()
         self.emails.add(email)
 
     def __repr__(self):
@@ -74,11 +105,11 @@ class Parent:
 
     @classmethod
     def find(cls, name):
-        ps = [p for p in Parent.all() if p.dad == name or p.mom == name]
+        ps = _parents_by_name.get(name, ())
         if len(ps)>1:
             raise Exception('There are more than one parent named "'+name+'"')
         elif len(ps)==1:
-            return ps[0]
+            return next(iter(ps))
         else:
             return None
 
@@ -88,35 +119,62 @@ class Parent:
             parent = _parents[parent.key]
         else:
             _parents[parent.key] = parent
+            for name in parent.key:
+                if name: _parents_by_name[name].add(parent)
         return parent
 
-class Check:
+    @classmethod
+    def merge(cls, keep, other):
+        '''move the children, phones and emails of parent other to keep, other leaves the parents table'''
+        for child in other.children: keep.add_child(child)
+        other.children.clear()
+        for phone in other.phones: keep.add_phone(phone)
+        for email in other.emails: keep.add_email(email)
+        del _parents[other.key]
+        for name in other.key:
+            if name:
+                _parents_by_name[name].discard(other)
+                _parents_by_name[name].add(keep)     # still found by the names of other
+        _pod_children.clear()
+        global _merges
+        _merges += 1
+        return keep
+
+class Check(object):
+    __slots__ = ('amt', 'no', 'status')
+
     def __init__(self, amt, no, status):
         if not amt:
             self.amt = 0
         else:
             self.amt = int(amt)
         self.no  = no
-        self.status = status
+        self.status = intern(status)
 
     def __str__(self):
         if not no: return 'NA'
         return '$%d (%s)'%(self.amt, self.status)
 
-class Student:
+class Student(object):
+    __slots__ = ('chinesename', 'name', 'status', 'pod', 'id', 'parent', 'cls', 'culture',
+                 'tuition_check', 'pod_check', 'donation_check')
+
     def __init__(self, id, chinesename, name, status, pod=False):
         # assign 3 Chinese full spaces for empty Chinese name
         if chinesename == "": chineseName = None
         self.chinesename = chinesename
         self.name = _proc_name(name)
-        self.status = status
+        self.status = intern(status)
         self.pod    = pod
-        self.id     = self.key = int(id)
+        self.id     = int(id)
         self.parent = None
         self.cls    = None
         self.culture = None
         self.tuition_check = self.pod_check = self.donation_check = None
     
+    @property
+    def key(self): return self.id
+
     def __repr__(self):
         return '[ID=%3d, %s (%s)]' % (self.id, self.name, self.cls.name)
 
@@ -126,9 +184,22 @@ class Student:
     def register(self, cls, culture = None):
         self.cls = cls
         cls.students.add(self)
+        _students_by_name_cls.setdefault((self.name, cls.name), self)
         if culture:
             self.culture = culture
             culture.students.add(self)
+            _students_by_name_cls.setdefault((self.name, culture.name), self)
+
+    def register_culture(self, culture):
+        '''move the student to culture class culture, None to no culture class'''
+        old = self.culture
+        if old is not None:
+            old.students.discard(self)
+            if _students_by_name_cls.get((self.name, old.name)) is self: del _students_by_name_cls[(self.name, old.name)]
+        self.culture = culture
+        if culture is not None:
+            culture.students.add(self)
+            _students_by_name_cls.setdefault((self.name, culture.name), self)
 
     def isActive(self):
         return self.status in ["Received", "Active", "Pending"]
@@ -168,15 +239,13 @@ class Student:
     def find(cls, name, classname=None):
         '''return student with specific name and classname, if given'''
         if classname:
-            cls = Class.get(classname)
-            for s in cls.students:
-                if s.name == name: return s
+            return _students_by_name_cls.get((name, classname))
         else:
-            ss = [s for s in Student.all() if s.name == name]
+            ss = _students_by_name.get(name, ())
             if len(ss)>1:
                 raise Exception('There are more than one student named "'+name+'", please add classname to distinguish')
             elif len(ss)==1:
-                return ss[0]
+                return next(iter(ss))
         return None
 
     @classmethod
@@ -186,61 +255,78 @@ class Student:
             student = _students[student.key]
         else:
             _students[student.key] = student
+            _students_by_name[student.name].add(student)
         return student
 
-class Class:
+# kind/session/grade of a class, parsed once from its name
+#   kind:      "language", "adult", "ap" or "culture"
+#   session:   "AM", "PM" or "NOON"
+#   grade:     0 for K, 100 for adults, None for culture classes
+#   bilingual: True for bilingual language classes
+ClassInfo = namedtuple('ClassInfo', ['kind', 'session', 'grade', 'bilingual'])
+
+# language classes not following the K/B/C naming, this could change each year
+class_rules = OrderedDict([
+    ('AA',     ClassInfo('adult', 'AM', 100, True)),
+    ('Pre-AP', ClassInfo('ap',    'AM', 9,   False)),
+    ('AP',     ClassInfo('ap',    'AM', 10,  False)),
+])
+
+_culture_class_info = ClassInfo('culture', 'NOON', None, False)
+
+class Class(object):
+    __slots__ = ('name', 'students', 'info')
     _language_class_rep = re.compile(r'(K|C|B)(\d+)?(A|P)(\d+)?')  # regular expression to detection AM/PM class
     def __init__(self, name):
-        self.name = self.key = name
+        self.name = name
         self.students = set()
+        self.info = Class.classify(name)
+
+    @property
+    def key(self): return self.name
 
     def __repr__(self): return self.name
 
+    @classmethod
+    def classify(cls, name, rules=None):
+        '''return ClassInfo of a class name, special names are looked up in rules (default class_rules)'''
+        if rules is None: rules = class_rules
+        if name in rules: return rules[name]
+        m = Class._language_class_rep.match(name)
+        if not m: return _culture_class_info
+        if m.group(1) == "K":
+            grade = 0
+        elif m.group(2):
+            grade = int(m.group(2))
+        else:
+            grade = None    # unrecognized, grade() complains
+        return ClassInfo('language', m.group(3)+"M", grade, m.group(1) == "C")
+
     def isCultureClass(self):
-        return not self.isLanguageClass()
+        return self.info.kind == "culture"
             
     def isLanguageClass(self):
-        m = Class._language_class_rep.match(self.name)
-        if m or self.isAdultClass() or self.isAP():
-            return True
-        return False
+        return self.info.kind != "culture"
 
-    def isAdultClass(self): return self.name == "AA"
+    def isAdultClass(self): return self.info.kind == "adult"
 
     def isBilingual(self):
-        return self.isLanguageClass() and (self.name == "AA" or self.name[:1] == "C")
+        return self.info.bilingual
 
     def isAP(self):
-        return self.name in ["Pre-AP", "AP"]
+        return self.info.kind == "ap"
 
     def ampm(self):
         '''return NOON/AM/PM'''
-        if self.isCultureClass(): return "NOON"
-        if self.isAdultClass(): return "AM"
-        if self.name == "Pre-AP": return "AM"   # this could change each year
-        if self.name == "AP": return "AM"       # this could change each year
-
-        m = Class._language_class_rep.match(self.name)
-        if m:
-            return m.group(3)+"M"
-        else:
-            raise Exception('Unrecognized class name "'+self.name+'"')
+        return self.info.session
             
     def isMorningClass(self):
-        return self.ampm() == "AM"
+        return self.info.session == "AM"
 
     def grade(self):
-        if self.isCultureClass(): return None
-        if self.name == "AA": return 100
-        if self.name == "Pre-AP": return 9
-        if self.name == "AP": return 10
-        
-        m = Class._language_class_rep.match(self.name)
-        if m:
-            if m.group(1) == "K": return 0
-            return int(m.group(2))
-        else:
+        if self.info.kind == "language" and self.info.grade is None:
             raise Exception('Unrecognized class name "'+self.name+'"')
+        return self.info.grade
 
     @classmethod
     def all(cls):
@@ -259,96 +345,317 @@ class Class:
         return o
 
 
-def __init_registration(filename):
-    '''read from csv file download from google spreadsheet, and initialize students/parents/classes tables'''
-    headerNames = (
-      ID,  SCHOOL_YEAR, CLASS, STUDENT_CHINESE_NAME, STUDENT, POD, 
-      # FAMILY, FAMILY_MOTHER, FAMILY_HOME_PHONE,
-      FAMILY, FAMILY_MOTHER, FAMILY_HOME_PHONE_1, FAMILY_HOME_PHONE_2, 
-      # FAMILY_MOBILE_PHONE, FAMILY_EMAIL, STATUS, 
-      FAMILY_MOBILE_PHONE_1, FAMILY_MOBILE_PHONE_2, 
-      FAMILY_EMAIL_1, FAMILY_EMAIL_2, STATUS, 
-      TUITION_CHECK_AMOUNT, TUITION_CHECK_NUM, TUITION_CHECK_STATUS, 
-      ONDUTY_CHECK_NUM, ONDUTY_CHECK_STATUS, 
-      DONATION, DONATION_CHECK_NUM, DONATION_STATUS, 
-      AGREE_TO_TERM_AND_CONDITIONS, 
-      CULTURE_CLASS, CULTURE_CHOICE_1, CULTURE_CHOICE_2, CULTURE_CHOICE_3,
-      MEMO
-    ) = (
-     'ID', 'School year', 'Class', 'Student:Chinese name', 'Student', 'POD', 
-     # 'Family', 'Family:Mother', 'Family:Home phone',
-     'Family', 'Family:Mother', 'Family:Home phone 1', 'Family:Home phone 2', 
-     # 'Family:Mobile phone', 'Family:Email', 'Status', 
-     'Family:Mobile phone 1', 'Family:Mobile phone 2', 
-     'Family:Email 1', 'Family:Email 2', 'Status', 
-     'Tuition check amount', 'Tuition check #', 'Tuition check status', 
-     'Onduty check #', 'Onduty check status', 
-     'Donation', 'Donation check #', 'Donation status', 
-     'Agree to Term and Conditions', 
-     'Culture Class', 'Culture choice #1', 'Culture Choice #2', 'Culture choice #3', 
-     'Memo')
-
+# columns of the registration sheet, field name of Registration ==> csv header
+_registration_columns = OrderedDict([
+    ('id',                   'ID'),
+    ('school_year',          'School year'),
+    ('cls',                  'Class'),
+    ('chinese_name',         'Student:Chinese name'),
+    ('student',              'Student'),
+    ('pod',                  'POD'),
+    # 'Family', 'Family:Mother', 'Family:Home phone',
+    ('family',               'Family'),
+    ('family_mother',        'Family:Mother'),
+    ('home_phone_1',         'Family:Home phone 1'),
+    ('home_phone_2',         'Family:Home phone 2'),
+    # 'Family:Mobile phone', 'Family:Email', 'Status',
+    ('mobile_phone_1',       'Family:Mobile phone 1'),
+    ('mobile_phone_2',       'Family:Mobile phone 2'),
+    ('email_1',              'Family:Email 1'),
+    ('email_2',              'Family:Email 2'),
+    ('status',               'Status'),
+    ('tuition_check_amount', 'Tuition check amount'),
+    ('tuition_check_num',    'Tuition check #'),
+    ('tuition_check_status', 'Tuition check status'),
+    ('onduty_check_num',     'Onduty check #'),
+    ('onduty_check_status',  'Onduty check status'),
+    ('donation',             'Donation'),
+    ('donation_check_num',   'Donation check #'),
+    ('donation_status',      'Donation status'),
+    ('agree_to_terms',       'Agree to Term and Conditions'),
+    ('culture_class',        'Culture Class'),
+    ('culture_choice_1',     'Culture choice #1'),
+    ('culture_choice_2',     'Culture Choice #2'),
+    ('culture_choice_3',     'Culture choice #3'),
+    ('memo',                 'Memo'),
+])
+
+# one parsed row of the registration sheet, lineno is the line number in csv file
+Registration = namedtuple('Registration', ['lineno'] + _registration_columns.keys())
+
+# parts of the registration a tool can leave out, see init(needs), ==> fields read for it
+registration_parts = OrderedDict([
+    ('checks',   ['tuition_check_amount', 'tuition_check_num', 'tuition_check_status',
+                  'donation', 'donation_check_num', 'donation_status']),
+    ('contacts', ['home_phone_1', 'home_phone_2', 'mobile_phone_1', 'mobile_phone_2', 'email_1', 'email_2']),
+    ('culture',  ['culture_class']),
+])
+# fields always read, the onduty check decides POD eligibility
+_core_fields = ['id', 'cls', 'chinese_name', 'student', 'pod', 'family', 'family_mother', 'status',
+                'onduty_check_num', 'onduty_check_status']
+
+def _needed_fields(needs):
+    '''return the fields of Registration read for the parts needs, raise ValueError for an unknown part'''
+    unknown = [part for part in needs if part not in registration_parts]
+    if unknown: raise ValueError('unknown registration part %s' % ', '.join(unknown))
+    return set(_core_fields + [f for part in needs for f in registration_parts[part]])
+
+class RegistrationError(Exception):
+    '''a problem with one row of the registration sheet'''
+    def __init__(self, lineno, message):
+        Exception.__init__(self, 'line %d: %s' % (lineno, message))
+        self.lineno  = lineno
+        self.message = message
+
+def iter_registration(filename, fields=None):
+    '''parse csv file download from google spreadsheet, yield one Registration per row
+
+    fields: the fields to read (default all), the others are left empty'''
     with open(filename, 'rb') as csvfile:
-        csvreader = csv.DictReader(csvfile)
+        csvreader = csv.reader(csvfile)
+        header = [h.strip() for h in next(csvreader, [])]
+        width = len(header)
+        index = []
+        for field, column in _registration_columns.iteritems():
+            if fields is not None and field not in fields:
+                index.append(width)     # the empty column appended to every row
+                continue
+            if column not in header:
+                raise RegistrationError(1, 'missing column "%s"' % column)
+            index.append(header.index(column))
+
         for row in csvreader:
-            row = {k: v.strip(' \n\t') for k, v in row.iteritems()}
+            if not row: continue
+            if len(row) != width: row = (row + [''] * width)[:width]   # cells past the header are dropped
+            row.append('')
+            yield Registration(csvreader.line_num, *[row[i].strip(' \n\t') for i in index])
+
+def _make_check(rec, what, amt, no, status):
+    '''return the check a student keeps, None if the columns are empty, raise RegistrationError if invalid'''
+    if not no:
+        if status in ['Received']:
+            raise RegistrationError(rec.lineno, '%s (%s) missing %s check number' % (rec.student, rec.cls, what))
+        if status not in ['Pending']:
+            return None
+    try:
+        return Check(amt, no, status)
+    except ValueError as err:
+        raise RegistrationError(rec.lineno, 'bad %s check amount (%s)' % (what, err))
+
+def _make_checks(rec):
+    '''return (tuition, pod, donation) checks of a registration, None for no check, raise RegistrationError if invalid'''
+    return (_make_check(rec, 'tuition', rec.tuition_check_amount, rec.tuition_check_num, rec.tuition_check_status),
+            _make_check(rec, 'onduty', 50, rec.onduty_check_num, rec.onduty_check_status),
+            _make_check(rec, 'donation', rec.donation, rec.donation_check_num, rec.donation_status))
+
+def _validate_registration(rec, checks=True):
+    '''return checks of a registration, raise RegistrationError if the row can not be loaded
+
+    checks=False only makes the onduty check, the tuition and donation checks are None'''
+    try:
+        int(rec.id)
+    except ValueError:
+        raise RegistrationError(rec.lineno, 'bad student ID "%s"' % rec.id)
+    if not rec.family_mother and not rec.family and not rec.cls == "AA" and not rec.pod == "Adult Student":
+        raise RegistrationError(rec.lineno, '%s (%s) has no Mom and Dad name' % (rec.student, rec.cls))
+    if not checks: return (None, _make_check(rec, 'onduty', 50, rec.onduty_check_num, rec.onduty_check_status), None)
+    return _make_checks(rec)
+
+def _load_registration(rec, checks, contacts=True):
+    '''add a validated registration to students/parents/classes tables, without phones and emails if not contacts'''
+    student = Student.add(Student(id=rec.id, chinesename=rec.chinese_name, name=rec.student, status=rec.status))
+
+    cls = _classes.get(rec.cls) or Class.add(Class(rec.cls))
+    culture = rec.culture_class.lower() # culture class name is case insensitive
+    if not culture:
+        culture = None
+    else:
+        culture = _classes.get(culture) or Class.add(Class(culture))
+    student.register(cls, culture)
+
+    role = rec.pod
+
+    student.tuition_check, student.pod_check, student.donation_check = checks
+
+    if cls.isAdultClass() or role == "Adult Student":  # for adult students
+        student.pod = False
+        parent = Parent(student.name, student.name)  # adult's parents are his/her own
+    else:
+        student.pod = not (not student.isActive() or \
+                           (role and role in ["Board member", "Boardmember", "Board Member", "Teacher", "teacher", "Exempt"]) or \
+                           student.pod_check is None)
+        parent = Parent(rec.family_mother, rec.family)
+    parent = Parent.add(parent)
+
+    if contacts:
+        parent.add_phone(rec.home_phone_1)
+        parent.add_phone(rec.home_phone_2)
+        parent.add_phone(rec.mobile_phone_1)
+        parent.add_phone(rec.mobile_phone_2)
+
+        parent.add_email(rec.email_1)
+        parent.add_email(rec.email_2)
+    parent.add_child(student)
+
+def __init_registration(filename, skip_errors=False, needs=None):
+    '''read from csv file download from google spreadsheet, and initialize students/parents/classes tables
+
+    skip_errors=False stops at the first invalid row, otherwise invalid rows are skipped and
+    returned as a list of RegistrationError
+    needs: the registration_parts to load, default all'''
+    fields = None if needs is None else _needed_fields(needs)
+    checks, contacts = needs is None or 'checks' in needs, needs is None or 'contacts' in needs
+    errors = []
+    for rec in iter_registration(filename, fields):
+        try:
+            rec_checks = _validate_registration(rec, checks)
+        except RegistrationError as err:
+            if not skip_errors: raise
+            errors.append(err)
+            continue
+        _load_registration(rec, rec_checks, contacts)
+    return errors
 
-            student = Student.add(Student(id=row[ID], chinesename=row[STUDENT_CHINESE_NAME], name=row[STUDENT], status=row[STATUS]))
+def __init_boardmember(filename):
+    pass
 
-            cls = Class(row[CLASS])
-            cls = Class.add(cls)
-            culture = Class(row[CULTURE_CLASS].lower()) # culture class name is case insensitive
-            if not culture.name: 
-                culture = None
-            else:
-                culture = Class.add(culture)
-            student.register(cls, culture)
-
-            role = row[POD]
-
-            tuition_check = Check(row[TUITION_CHECK_AMOUNT], row[TUITION_CHECK_NUM], row[TUITION_CHECK_STATUS])
-            if not tuition_check.no and tuition_check.status in ['Received']:
-                raise Exception(str(student)+' missing tuition check number')
-            if tuition_check.no or tuition_check.status in ['Pending']:
-                student.tuition_check = tuition_check
-
-            pod_check     = Check(50, row[ONDUTY_CHECK_NUM], row[ONDUTY_CHECK_STATUS])
-            if not pod_check.no and pod_check.status in ['Received']:
-                raise Exception(str(student)+' missing onduty check number')
-            if pod_check.no or pod_check.status in ['Pending']:
-                student.pod_check = pod_check
-
-            donation_check= Check(row[DONATION], row[DONATION_CHECK_NUM], row[DONATION_STATUS])
-            if not donation_check.no and donation_check.status in ['Received']:
-                raise Exception(str(student)+' missing donation check number')
-            if donation_check.no or donation_check.status in ['Pending']:
-                student.donation_check = donation_check
-
-            if cls.isAdultClass() or role == "Adult Student":  # for adult students
-                student.pod = False
-                parent = Parent(student.name, student.name)  # adult's parents are his/her own
+# snapshots of loaded registration csv files are kept here, see init(cache=True)
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ccl')
+_CACHE_VERSION = 1
+
+def _cache_key(filename, needs=None):
+    '''return the key a snapshot of filename must match: path, size, mtime, content hash, class rules and parts loaded'''
+    st = os.stat(filename)
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha.update(block)
+    return (_CACHE_VERSION, sys.version, os.path.abspath(filename), st.st_size, st.st_mtime, sha.hexdigest(), repr(class_rules),
+            None if needs is None else sorted(needs))
+
+def _cache_file(filename, needs=None):
+    '''return the snapshot file of filename, a load of some registration_parts has one of its own'''
+    name = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    if needs is not None: name += '-' + '-'.join(sorted(needs))
+    return os.path.join(cache_dir, name + '.snapshot')
+
+def _save_snapshot(path, key):
+    '''write the tables as flat rows, the links are kept as row numbers'''
+    classes  = Class.all()
+    parents  = Parent.all()
+    cindex   = dict((c, i) for i, c in enumerate(classes))
+    pindex   = dict((p, i) for i, p in enumerate(parents))
+    def check(c):
+        return c and (c.amt, c.no, c.status)
+    students = [(s.id, s.chinesename, s.name, s.status, s.pod, cindex[s.cls],
+                 cindex.get(s.culture), pindex.get(s.parent),
+                 check(s.tuition_check), check(s.pod_check), check(s.donation_check)) for s in Student.all()]
+    tables = ([c.name for c in classes],
+              [(p.mom, p.dad, list(p.phones), list(p.emails)) for p in parents],
+              students)
+    if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump(key, f)
+        marshal.dump(tables, f)
+    os.rename(tmp, path)
+
+def without_gc(fn, *args):
+    '''return fn(*args) with the garbage collector paused, for loads that only make new objects:
+    collecting them meanwhile is wasted time'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return fn(*args)
+    finally:
+        if enabled: gc.enable()
+
+def _load_snapshot(path, key):
+    '''fill the tables from a snapshot, return False if there is no valid snapshot for key
+
+    The rows were normalized when the snapshot was written, so objects are filled in directly
+    without going through the constructors.'''
+    try:
+        with open(path, 'rb') as f:
+            if marshal.load(f) != key: return False
+            classes, parents, students = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return False
+
+    new = object.__new__
+    classes = [Class.add(Class(name)) for name in classes]
+    ps = []
+    for mom, dad, phones, emails in parents:
+        p = new(Parent)
+        p.mom, p.dad, p.key = mom, dad, (mom, dad)
+        p.phones = set(phones) if phones else _no_contacts
+        p.emails = set(emails) if emails else _no_contacts
+        p.children = set()
+        _parents[p.key] = p
+        if mom: _parents_by_name[mom].add(p)
+        if dad: _parents_by_name[dad].add(p)
+        ps.append(p)
+    def check(c):
+        if not c: return None
+        o = new(Check)
+        o.amt, o.no, o.status = c[0], c[1], intern(c[2])
+        return o
+    for (id, chinesename, name, status, pod, cls, culture, parent,
+         tuition_check, pod_check, donation_check) in students:
+        s = new(Student)
+        s.id = id
+        s.chinesename, s.name, s.status, s.pod = chinesename, name, intern(status), pod
+        s.tuition_check, s.pod_check, s.donation_check = check(tuition_check), check(pod_check), check(donation_check)
+        _students[id] = s
+        _students_by_name[name].add(s)
+        s.parent = s.culture = None
+        s.register(classes[cls], None if culture is None else classes[culture])
+        if parent is not None: ps[parent].add_child(s)
+    return True
+
+def init(regcsv, bmcsv=None, skip_errors=False, cache=False, needs=None):
+    '''initialize CCL database, return list of RegistrationError of the skipped rows
+
+    skip_errors=True skips the invalid rows instead of raising the RegistrationError of the first
+
+    cache=True loads from the snapshot of regcsv kept in cache_dir if the file has not changed
+    since, and writes a new snapshot otherwise (only for a load without errors)
+    needs: the registration_parts a tool uses, default all.  Parts left out are not read:
+    no tuition/donation checks (nor their errors), no phones and emails, no culture classes'''
+    if needs is not None:
+        _needed_fields(needs)   # ValueError for an unknown part before anything is loaded
+        needs = None if set(needs) >= set(registration_parts) else set(needs)
+    with instrument.phase('csv_load'):
+        _pod_children.clear()
+        if cache:
+            key, path = _cache_key(regcsv, needs), _cache_file(regcsv, needs)
+            loaded = without_gc(_load_snapshot, path, key)
+            if loaded:
+                errors = []
             else:
-                student.pod = not (not student.isActive() or \
-                                   (role and role in ["Board member", "Boardmember", "Board Member", "Teacher", "teacher", "Exempt"]) or \
-                                   (not pod_check.no and pod_check.status not in ["Pending"]))
-                parent = Parent(row[FAMILY_MOTHER], row[FAMILY])
-            parent = Parent.add(parent)
+                reset()
+                errors = __init_registration(regcsv, skip_errors, needs)
+                if not errors: _save_snapshot(path, key)
+        else:
+            errors = __init_registration(regcsv, skip_errors, needs)
+    if bmcsv: __init_boardmember(bmcsv)
+    return errors
 
-            parent.add_phone(row[FAMILY_HOME_PHONE_1])
-            parent.add_phone(row[FAMILY_HOME_PHONE_2])
-            parent.add_phone(row[FAMILY_MOBILE_PHONE_1])
-            parent.add_phone(row[FAMILY_MOBILE_PHONE_2])
+def roster_snapshot():
+    '''return {student ID: (status, class, pod)} of the loaded students'''
+    return dict((s.id, (s.status, s.cls.name, s.pod)) for s in Student.all())
 
-            parent.add_email(row[FAMILY_EMAIL_1])
-            parent.add_email(row[FAMILY_EMAIL_2])
-            parent.add_child(student)
+def save_roster_snapshot(filename):
+    with open(filename, 'wt') as f:
+        json.dump(dict((str(k), v) for k, v in roster_snapshot().iteritems()), f)
 
-def __init_boardmember(filename):
-    pass
+def load_roster_snapshot(filename):
+    with open(filename, 'rt') as f:
+        return dict((int(k), tuple(v)) for k, v in json.load(f).iteritems())
 
-def init(regcsv, bmcsv=None):
-    __init_registration(regcsv)
-    if bmcsv: __init_boardmember(bmcsv)
+def changed_students(snapshot):
+    '''return students whose status, class or POD eligibility differ from snapshot, or who are new'''
+    return [s for s in Student.all() if snapshot.get(s.id) != (s.status, s.cls.name, s.pod)]
 
 
 # def check():
@@ -377,6 +684,36 @@ def _proc_name_lower_upper(line):
             upper = int(m.group(5))
     return name, lower, upper
 
+def _tokenize_cst(lines):
+    '''split lines of a constraint file into (lineno, kind, value) tokens, each line is looked at once
+        @2015-09-12          ==> ('date', date(2015, 9, 12))
+        #AM=2,4              ==> ('header', ('AM', 2, 4))
+        Foo Bao (B3P)        ==> ('student', ('Foo Bao', 'B3P'))
+    anything else is ('bad', line)'''
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line: continue
+        c = line[0]
+        if c == '@':
+            try:
+                y, m, d = line[1:].split('-', 2)
+                yield lineno, 'date', date(int(y), int(m), int(d[:2]))
+            except ValueError:
+                yield lineno, 'bad', line
+        elif c == '#':
+            name, lower, upper = _proc_name_lower_upper(line)
+            if name is None:
+                yield lineno, 'bad', line
+            else:
+                yield lineno, 'header', (name, lower, upper)
+        else:
+            name, paren, rest = line.partition('(')
+            name, cls = name.strip(), rest.rstrip().rstrip(')').strip()
+            if not paren or not name or not cls or not rest.rstrip().endswith(')'):
+                yield lineno, 'bad', line
+            else:
+                yield lineno, 'student', (' '.join(name.split()), cls)
+
 def _slice(nslice, total):
     r = float(total)/float(nslice)
     fprev, iprev, i = 0.0, 0, 0
@@ -389,8 +726,135 @@ def _slice(nslice, total):
         yield int(icur-iprev)
         fprev, iprev, i = fcur, icur, i+1
         
+def _pod_families():
+    '''return {parent: active POD children sorted by ID}, ordered by the ID of the first child
+
+    The order does not depend on how the tables were loaded (csv or snapshot), so a seed
+    gives the same fill either way.'''
+    if not _pod_children:
+        families = []
+        for parent in Parent.all():
+            kids = sorted((s for s in parent.children if s.isActive() and s.pod), key=lambda s: s.id)
+            if kids: families.append( (kids[0].id, parent, kids) )
+        families.sort(key=lambda f: f[0])
+        for id, parent, kids in families: _pod_children[parent] = kids
+    return _pod_children
+
 class Arrangement:
-    
+
+    class Pool:
+        '''students waiting for duty spots, in selection order
+
+        Taking a student only marks its slot, so the order of the others never changes.
+        Taken slots are skipped through path-compressed "next slot" links.'''
+        def __init__(self, students):
+            self.students = list(students)
+            self._next = range(len(self.students)+1)   # _next[i] == i if slot i is free
+            self._left = len(self.students)
+
+        def __len__(self): return self._left
+
+        def __iter__(self):
+            i = self.first()
+            while i < len(self.students):
+                yield self.students[i]
+                i = self.after(i)
+
+        def first(self): return self._find(0)
+
+        def after(self, i):
+            '''return index of the first free slot after slot i, len(students) if none'''
+            return self._find(i+1)
+
+        def _find(self, i):
+            nxt = self._next
+            while nxt[i] != i:
+                nxt[i] = nxt[nxt[i]]
+                i = nxt[i]
+            return i
+
+        def take(self, i):
+            '''remove the student at slot i from the pool, return the student'''
+            self._next[i] = i+1
+            self._left -= 1
+            return self.students[i]
+
+    class Tally:
+        '''# of duties of each student and # of children on duty of each family,
+        kept up to date by Duty.add()/remove() of the duties sharing it'''
+        def __init__(self, duties=()):
+            self.students = {}   # student ==> # of duties
+            self.families = {}   # parent ==> # of children with duties
+            self.merges = _merges   # families is stale once Parent.merge() is called again
+            self.version = 0     # bumped by each add()/remove()
+            for duty in duties:
+                for s in duty.students: self.add(s)
+
+        def add(self, student):
+            n = self.students.get(student, 0)
+            self.students[student] = n+1
+            if n == 0: self.families[student.parent] = self.families.get(student.parent, 0) + 1
+            self.version += 1
+
+        def remove(self, student):
+            n = self.students[student]
+            if n > 1:
+                self.students[student] = n-1
+            else:
+                del self.students[student]
+                self.families[student.parent] = self.families.get(student.parent, 0) - 1
+            self.version += 1
+
+        def copy(self):
+            other = copy.copy(self)
+            other.students, other.families = dict(self.students), dict(self.families)
+            return other
+
+    class Calendar:
+        '''the duties by date and by name, kept up to date by Arrangement._add_duty()
+
+        The dates are sorted for range queries with bisect, the duties of a date are in the
+        order they were added, the duties of a name by date.'''
+        def __init__(self, duties=()):
+            self.dates   = []   # sorted dates with duties
+            self.by_date = {}   # date ==> [duty]
+            self.by_key  = {}   # (date, name) ==> duty
+            self.by_name = {}   # name ==> ([sorted dates], [duty of each date])
+            for duty in duties: self.add(duty)
+
+        def add(self, duty):
+            ds = self.by_date.get(duty.date)
+            if ds is None:
+                bisect.insort(self.dates, duty.date)
+                ds = self.by_date[duty.date] = []
+            ds.append(duty)
+            self.by_key[(duty.date, duty.name)] = duty
+            dates, named = self.by_name.setdefault(duty.name, ([], []))
+            i = bisect.bisect_right(dates, duty.date)
+            dates.insert(i, duty.date)
+            named.insert(i, duty)
+
+        def get(self, dt, name):
+            '''return the duty of a name on a date, None if there is none'''
+            return self.by_key.get((dt, name))
+
+        def on(self, dt):
+            '''return the duties of a date'''
+            return self.by_date.get(dt, [])
+
+        def dates_after(self, dt):
+            '''return the sorted dates with duties after dt'''
+            return self.dates[bisect.bisect_right(self.dates, dt):]
+
+        def since(self, first):
+            '''return the duties on or after date first, by date'''
+            return [duty for dt in self.dates[bisect.bisect_left(self.dates, first):] for duty in self.by_date[dt]]
+
+        def named(self, name, first=date.min):
+            '''return the duties of a name on or after date first, by date'''
+            dates, named = self.by_name.get(name, ((), ()))
+            return named[bisect.bisect_left(dates, first):]
+
     class NoEnoughStudent(Exception):
         def __init__(self, deficit):
             self.deficit = deficit
@@ -404,6 +868,7 @@ class Arrangement:
             self.name    = name
             self.how_many = how_many
             self.students = []
+            self.tally = None   # Arrangement.Tally to keep up to date
 
         def __repr__(self):
             r = '@%s (%s) %d' % (self.date, self.name, self.n_filled())
@@ -426,6 +891,14 @@ class Arrangement:
             elif self.how_many <= self.n_filled():
                 self.how_many = self.n_filled()
 
+        def add(self, student):
+            self.students.append(student)
+            if self.tally is not None: self.tally.add(student)
+
+        def remove(self, student):
+            self.students.remove(student)
+            if self.tally is not None: self.tally.remove(student)
+
         def n_filled(self):  return len(self.students)
         
         def isFilled(self): return self.how_many is not None and self.how_many == self.n_filled()
@@ -449,17 +922,24 @@ class Arrangement:
         def _fill_n_spot(self, pool, n, poolname):  # find n student from pool without parent confliction
             n = int(n)
             pj = set([ s.parent for s in self.students ])  # alread assigned
-            i, m, l = 0, n, len(pool)
-            while i < len(pool) and m > 0:
-                s = pool[i]
-                if self.is_student_qualified(s) and s.parent not in pj:
-                    pj.add(s.parent)
-                    selected = pool.pop(i)
-                    print >> sys.stderr, '+   '+str(selected)
-                    self.students.append(selected)
-                    m -= 1
-                    continue
-                i += 1
+            debug = _log.isEnabledFor(logging.DEBUG)
+            i, m, l = pool.first(), n, len(pool.students)
+            scanned = conflicts = 0
+            while i < l and m > 0:
+                s = pool.students[i]
+                scanned += 1
+                if self.is_student_qualified(s):
+                    if s.parent not in pj:
+                        pj.add(s.parent)
+                        selected = pool.take(i)
+                        if debug: _log.debug('+   %s', selected)
+                        self.add(selected)
+                        m -= 1
+                    else:
+                        conflicts += 1
+                i = pool.after(i)
+            instrument.count('candidates_scanned', scanned)
+            instrument.count('parent_conflicts', conflicts)
             if m > 0: raise Arrangement.NoEnoughStudent(m)
 
         def fill(self, am_pool, pm_pool, am_vs_pm):  # am_vs_pm = (m, n), the rate of student from AM and PM is m:n
@@ -469,8 +949,8 @@ class Arrangement:
             nspot = self.n_spot()
             if nspot == 0: return 0, 0
 
-            print >> sys.stderr, '===== %s(%s) ====='%(self.date, self.name)
-            print >> sys.stderr, '#TOFILL = %d/%d'%(nspot, self.how_many)
+            _log.debug('===== %s(%s) =====', self.date, self.name)
+            _log.debug('#TOFILL = %d/%d', nspot, self.how_many)
 
             am, pm = am_vs_pm
             if am == 0: 
@@ -488,8 +968,7 @@ class Arrangement:
             
             for pool, n, poolname in q: self._fill_n_spot(pool, n, poolname)
 
-            print >> sys.stderr, '#+AM=%d  +PM=%d'%(am, pm)
-            print >> sys.stderr
+            _log.debug('#+AM=%d  +PM=%d', am, pm)
             return am, pm
 
     class AMDuty(Duty):
@@ -516,169 +995,517 @@ class Arrangement:
                 student.cls.grade() > 2
 
     def __init__(self):
-         self.duties = []
+         self.duties = []    # in the order of the constraint file
+         self.calendar = Arrangement.Calendar()   # the duties by date and name
          self.dsp_lower = OrderedDict()
          self.dsp_upper = OrderedDict()
+         self.dropped = []   # (duty, student) removed by load() since last assignment
+         self.seed = None    # seed of the last fill_duties()
+         self.best_score = None   # score() of the best fill of a search of several seeds
+         self.family_limits = {}   # parent ==> max # of duties of the family, default limit_prio
+         self._tally = None  # Tally of the duties, built by _family_tally()
+         self._queues = None # (key, candidate queues) of the last _candidate_queues()
 
     def __str__(self):
-        r = ''
+        r = []
+        self.write(r.append)
+        return ''.join(r)
+
+    def write(self, write):
+        '''write the .cst text duty by duty through write(str)'''
         for key, value in self.dsp_lower.iteritems():
             lower, upper = value, self.dsp_upper[key]
-            r += '#'+key+'='
             if lower == upper:
-                r += '%d'%lower
+                write('#%s=%d\n' % (key, lower))
             else:
-                r += '%d,%d'%(lower, upper)
-            r += '\n'
-        r += '\n'
+                write('#%s=%d,%d\n' % (key, lower, upper))
+        write('\n')
         for d in self.duties:
-            r += str(d) + '\n'
-        return r
+            write(str(d) + '\n')
 
-    def load(self, filename):
-        duty_date, duty = None, None
-        # [ID=100, Foo Bao (B3P)]
-        date_rep    = re.compile(r'@(\d{4})-(\d{1,2})-(\d{1,2})')
-        student_rep = re.compile(r'\s*([\ \w]+)\(\s*(.+)\s*\)\s*')
-        with open(filename, "rt") as cst:
-            for line in cst:
-                line = line.strip()
-                if not line: continue
-
-                # parse date
-                m = date_rep.match(line)
-                if m:
-                    duty_date = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-                    duty = None
-                    continue
+    def write_json(self, write):
+        '''write the machine-oriented format through write(str): JSON lines, the first one holds the
+        default ranges, then one line per duty with the IDs of its students'''
+        write(json.dumps({'dsp': OrderedDict((k, [v, self.dsp_upper[k]]) for k, v in self.dsp_lower.iteritems())}) + '\n')
+        for d in self.duties:
+            write('{"date": "%s", "name": %s, "students": %s}\n' % (d.date, json.dumps(d.name), json.dumps([s.id for s in d.students])))
 
-                # global default range settings
-                if duty_date is None: # global header for default parameters
-                    name, lower, upper = _proc_name_lower_upper(line)
-                    if lower is None or upper is None:
-                        raise Exception('Improver line in the header'+line)
-                    self.dsp_lower[name] = lower
-                    self.dsp_upper[name] = upper
-                    continue
+    def save(self, filename):
+        '''write to filename, in JSON lines if it ends with .json, .cst text otherwise'''
+        with open(filename, 'wt') as f:
+            if filename.endswith('.json'):
+                self.write_json(f.write)
+            else:
+                self.write(f.write)
+                f.write('\n')
+
+    class Diagnostic(namedtuple('Diagnostic', ['lineno', 'kind', 'message', 'student'])):
+        '''something load() noticed at a line of the constraint file
+
+        kind is one of:
+          withdrawn         student no longer active, dropped from the duty
+          session-changed   student moved to the other session, dropped from the AM/PM duty
+          duplicate-header  second # line of a date, or a duty (date and name) given again,
+                            its students go to the first one
+          range-ignored     lower != upper for a single duty
+          bad-line          line is not a date, a # line or "Name (Class)"
+          unknown-student   no such student
+          ambiguous-student more than one student of the name, none of them in the class
+          no-duty           student before any # line of a date'''
+        errors = ['bad-line', 'unknown-student', 'ambiguous-student', 'no-duty']
 
-                
-                # range setting of each duty
-                if line[:1] == "#":
-                    if duty is not None: continue # skip
-                    name, lower, upper = _proc_name_lower_upper(line)
+        def __str__(self):
+            return 'line %d: %s: %s' % (self.lineno, self.kind, self.message)
+
+    def load(self, filename, strict=True):
+        '''load a constraint file, return list of Diagnostic
+
+        strict=True raises an Exception at the first error (see Diagnostic.errors),
+        otherwise the offending lines are skipped and reported'''
+        with instrument.phase('cst_load'):
+            return self._load(filename, strict)
+
+    def _load(self, filename, strict):
+        Diagnostic = Arrangement.Diagnostic
+        diags = []
+        def report(lineno, kind, message, student=None):
+            d = Diagnostic(lineno, kind, message, student)
+            if strict and kind in Diagnostic.errors: raise Exception(str(d))
+            diags.append(d)
+
+        with open(filename, "rt") as cst:
+            first = cst.read(1)
+        if first == '{':
+            return self._load_json(filename, report, diags)
+
+        by_name_cls, by_name = _students_by_name_cls, _students_by_name
+        duty_date, duty = None, None
+        with open(filename, "rt") as cst:
+            for lineno, kind, value in _tokenize_cst(cst):
+                if duty_date is None and kind not in ['date', 'header']:
+                    raise Exception('Improver line in the header, line %d' % lineno)
+
+                if kind == 'student':
+                    if duty is None:
+                        report(lineno, 'no-duty', '%s (%s)' % value)
+                        continue
+                    sname, clsname = value
+                    student = by_name_cls.get(value)
+                    if student is None:
+                        ss = by_name.get(sname, ())
+                        if len(ss) > 1:
+                            report(lineno, 'ambiguous-student', 'more than one student named "%s", please add classname to distinguish' % sname)
+                            continue
+                        if not ss:
+                            report(lineno, 'unknown-student', '%s (%s)' % value)
+                            continue
+                        student = next(iter(ss))
+
+                    self._admit(duty, student, lineno, report)
+
+                elif kind == 'date':
+                    duty_date, duty = value, None
+
+                elif kind == 'header':
+                    name, lower, upper = value
+                    if duty_date is None: # global header for default parameters
+                        if lower is None or upper is None:
+                            raise Exception('Improver line in the header, line %d' % lineno)
+                        self.dsp_lower[name] = lower
+                        self.dsp_upper[name] = upper
+                        continue
+
+                    # range setting of each duty
+                    if duty is not None:
+                        report(lineno, 'duplicate-header', '#%s skipped, %s already has #%s' % (name, duty_date, duty.name))
+                        continue
+                    duty = self.calendar.get(duty_date, name)
+                    if duty is not None:
+                        report(lineno, 'duplicate-header', '#%s of %s again, its students go to the first one' % (name, duty_date))
+                        continue
                     how_many = None
                     if lower is not None and upper is not None: # use the value if lower == upper
                         if lower != upper:
-                            print >> sys.stderr, 'WARNING: constraint ignored at "'+line+'"'
+                            report(lineno, 'range-ignored', 'constraint ignored at #%s=%d,%d' % (name, lower, upper))
                         else:
                             how_many = lower
                     if how_many is not None and name in self.dsp_lower:  # use the default value if lower == upper
                         if self.dsp_lower[name] == self.dsp_upper[name]:
                             how_many = self.dsp_lower[name]
-                    if name == "AM":
-                        duty = Arrangement.AMDuty(duty_date, how_many)
-                    elif name == "PM":
-                        duty = Arrangement.PMDuty(duty_date, how_many)
-                    elif name == "PJ":
-                        duty = Arrangement.PJDuty(duty_date, how_many)
-                    else:
-                        duty = Arrangement.Duty(duty_date, name, how_many)
-                    self.duties.append(duty)
-                    continue
+                    duty = self._add_duty(duty_date, name, how_many)
 
-                # assigned student
-                m = student_rep.match(line)
-                if not m:  raise Exception('Not a valid student: '+line)
-                sname   = m.group(1).strip()
-                clsname = m.group(2).strip()
-                student = Student.find(sname, clsname)
-                if student is None:
-                    student = Student.find(sname)
-                    if student is None:
-                        raise Exception('Cannot find student: '+line)
-
-                if student.isActive():
-                    if duty.name in ["AM", "PM"] and duty.name != student.cls.ampm():   # student class changed since last assignment
-                        print >> sys.stderr, '-   %s  from %s (%s)' % (student, duty.date, duty.name)
-                    else:
-                        duty.students.append(student)
                 else:
-                    print >> sys.stderr, '-   %s  from %s (%s)' % (student, duty.date, duty.name)   # student withdraw since last assignment
+                    report(lineno, 'bad-line', 'not a valid student: %s' % value)
+        return diags
 
-    def _collect_avaliable_students(self):
-        assigned_students = set()
-        for duty in self.duties:
-            assigned_students |= set( duty.students )
-            
-        Candidate = namedtuple('Candidate', ['student', 'prio'])
-        cands = []
-        limit_prio = 2   # not more than 2 duties each parent
-        for parent in Parent.all():
-            done   = parent.children & assigned_students
-            ready  = parent.children - assigned_students
-            prio = len(done)
+    def _add_duty(self, duty_date, name, how_many=None):
+        duty_types = {"AM": Arrangement.AMDuty, "PM": Arrangement.PMDuty, "PJ": Arrangement.PJDuty}
+        if name in duty_types:
+            duty = duty_types[name](duty_date, how_many)
+        else:
+            duty = Arrangement.Duty(duty_date, name, how_many)
+        duty.tally = self._tally
+        self.duties.append(duty)
+        self.calendar.add(duty)
+        return duty
+
+    def _admit(self, duty, student, lineno, report):
+        '''add a loaded student to duty unless the student changed since last assignment'''
+        if not student.isActive():   # student withdraw since last assignment
+            report(lineno, 'withdrawn', '%s from %s (%s)' % (student, duty.date, duty.name), student)
+            self.dropped.append( (duty, student) )
+        elif duty.name in ["AM", "PM"] and duty.name != student.cls.ampm():   # student class changed since last assignment
+            report(lineno, 'session-changed', '%s from %s (%s)' % (student, duty.date, duty.name), student)
+            self.dropped.append( (duty, student) )
+        else:
+            duty.add(student)
+
+    def _load_json(self, filename, report, diags):
+        '''load the format of write_json(), students are looked up by ID'''
+        with open(filename, "rt") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip(): continue
+                try:
+                    o = json.loads(line, object_pairs_hook=OrderedDict)
+                    if lineno == 1:
+                        for name, (lower, upper) in o['dsp'].iteritems():
+                            self.dsp_lower[str(name)] = lower
+                            self.dsp_upper[str(name)] = upper
+                        continue
+                    y, m, d = o['date'].split('-')
+                    duty_date, name = date(int(y), int(m), int(d)), str(o['name'])
+                    ids = o['students']
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    if lineno == 1: raise Exception('Improver line in the header, line %d' % lineno)
+                    report(lineno, 'bad-line', 'not a valid duty: %s' % line.strip())
+                    continue
+                duty = self.calendar.get(duty_date, name)
+                if duty is None:
+                    duty = self._add_duty(duty_date, name)
+                else:
+                    report(lineno, 'duplicate-header', '%s of %s again, its students go to the first one' % (name, duty_date))
+                for id in ids:
+                    student = _students.get(id)
+                    if student is None:
+                        report(lineno, 'unknown-student', 'ID %s' % id)
+                    else:
+                        self._admit(duty, student, lineno, report)
+        return diags
+
+    Candidate = namedtuple('Candidate', ['student', 'prio'])  # prio: # of duties the parent already has
+
+    limit_prio = 2   # not more than 2 duties each family, see family_limits
+
+    def _family_tally(self):
+        '''return the Tally of the duties, the duties keep it up to date from then on
+
+        The Tally is counted again after a Parent.merge(), which moves children to another family.'''
+        if self._tally is None or self._tally.merges != _merges:
+            self._tally = Arrangement.Tally(self.duties)
+            self._queues = None
+            for duty in self.duties: duty.tally = self._tally
+        return self._tally
+
+    def _forget_tally(self):
+        '''call after assigning duty.students directly'''
+        self._tally = None
+        self._queues = None
+        for duty in self.duties: duty.tally = None
+
+    def _candidate_queues(self, parents=None):
+        '''return {prio: [Candidate]} for open duty spots, in family order
+
+        The queues are kept until a duty, family_limits or the families change, so fills of
+        copies made meanwhile (e.g. the trials of _search()) start from them.
+        The prio of a candidate is the # of its family's children already on duty, a family gets
+        candidates up to family_limits.get(parent, limit_prio).'''
+        tally = self._family_tally()
+        key = (tally.version, parents if parents is None else frozenset(parents), self.limit_prio,
+               frozenset(self.family_limits.iteritems()))
+        if self._queues is not None and self._queues[0] == key: return self._queues[1]
+
+        assigned, on_duty = tally.students, tally.families
+        limits, limit_prio = self.family_limits, self.limit_prio
+        Candidate = Arrangement.Candidate
+        queues = defaultdict(list)   # prio ==> candidates
+        for parent, ready in _pod_families().iteritems():
+            if parents is not None and parent not in parents: continue
+            prio, limit = on_duty.get(parent, 0), limits.get(parent, limit_prio)
             for s in ready:
-                if prio >= limit_prio: break
-                if not s.isActive() or not s.pod: continue
-                cands.append( Candidate(s, prio) )
+                if prio >= limit: break
+                if s in assigned: continue
+                queues[prio].append( Candidate(s, prio) )
                 prio += 1
-        ready_students = []
-        random.seed()
-        for prio in range(limit_prio):
-            ss = [s.student for s in cands if s.prio == prio]
-            random.shuffle(ss)
-            ready_students += ss
-        return ready_students
+        self._queues = (key, queues)
+        return queues
+
+    def _collect_candidates(self, parents=None, seed=None):
+        '''return candidates for open duty spots, shuffled within each prio, lower prio first
+
+        parents: only collect children of these parents, default all
+        seed:    seed of the shuffle, the same seed gives the same order for the same tables'''
+        queues = self._candidate_queues(parents)
+        ready_cands = []
+        rnd = random.Random(seed)
+        for prio in sorted(queues):
+            cands = list(queues[prio])   # the queues are kept for the next fill
+            rnd.shuffle(cands)
+            ready_cands += cands
+        return ready_cands
+
+    def _collect_avaliable_students(self, parents=None, seed=None):
+        return [c.student for c in self._collect_candidates(parents, seed)]
+
+    def _bootstrap_duties(self, after):
+        '''freeze duty spot prior to after date, or with n_filled() >= dsp_upper'''
+        for duty in self.duties:
+            if duty.date < after:
+                duty.bootstrap(0)  # freeze
+            else:
+                duty.bootstrap(self.dsp_lower[duty.name], self.dsp_upper[duty.name])
 
+    @staticmethod
+    def _fits(duty, student):
+        '''True if student may stay on/take a spot of duty'''
+        if not student.isActive() or not student.pod: return False
+        if duty.name in ["AM", "PM"] and duty.name != student.cls.ampm(): return False
+        return duty.is_student_qualified(student)
+
+    def repair_duties(self, changed, after=date.today(), seed=None):
+        '''re-fill after a date only the spots touched by changed students, return False if it fails
+
+        Changed students who no longer fit their duties are removed, their spots (and the spots
+        dropped by load()) are re-filled from the changed students' families first, and changed
+        students who became available are added to the emptiest open duties of their session.
+        Other families keep their spots.
+        seed:     seed of the candidate shuffle, kept in self.seed like fill_duties()'''
+        if seed is None: seed = random.SystemRandom().randint(0, 2**31-1)
+        self.seed = seed
+        _log.info('seed = %d', seed)
+        changed = set(changed)
+        holes = defaultdict(int)   # duty ==> # of spots to re-fill
+        for duty, student in self.dropped:
+            if duty.date >= after: holes[duty] += 1
+        for duty in self.calendar.since(after):
+            gone = [s for s in duty.students if s in changed and not Arrangement._fits(duty, s)]
+            for s in gone:
+                _log.debug('-   %s  from %s (%s)', s, duty.date, duty.name)
+                duty.remove(s)
+                holes[duty] += 1
+
+        pool = self._collect_avaliable_students(set(s.parent for s in changed if s.parent), seed)
+        am_pool = Arrangement.Pool(s for s in pool if s.cls.ampm() == "AM")
+        pm_pool = Arrangement.Pool(s for s in pool if s.cls.ampm() == "PM")
+        _log.info('%d changed students, %d spots to re-fill, #AM pool = %d, #PM pool = %d',
+                  len(changed), sum(holes.values()), len(am_pool), len(pm_pool))
+
+        short = []
+        for duty in sorted(holes, key=lambda d: d.date):
+            duty.how_many = duty.n_filled() + holes[duty]
+            try:
+                duty.fill(am_pool, pm_pool, (len(am_pool), len(pm_pool)))
+            except Arrangement.NoEnoughStudent:
+                instrument.count('no_enough_student')
+                short.append(duty)
+
+        if short:  # not enough from changed families, take from everybody
+            taken = set(s for d in self.duties for s in d.students)
+            pool = [s for s in self._collect_avaliable_students(seed=seed) if s not in taken]
+            all_am = Arrangement.Pool(s for s in pool if s.cls.ampm() == "AM")
+            all_pm = Arrangement.Pool(s for s in pool if s.cls.ampm() == "PM")
+            for duty in short:
+                try:
+                    duty.fill(all_am, all_pm, (len(all_am), len(all_pm)))
+                except Arrangement.NoEnoughStudent as err:
+                    instrument.count('no_enough_student')
+                    if duty.n_filled() < self.dsp_lower[duty.name]:
+                        _log.error('unable to fill %d %s duty spots, no enough students', err.deficit, duty.name)
+                        return False
+                    duty.how_many = duty.n_filled()
+            # students of the changed families may have been taken by a short duty
+            taken = set(s for d in short for s in d.students)
+            am_pool = Arrangement.Pool(s for s in am_pool if s not in taken)
+            pm_pool = Arrangement.Pool(s for s in pm_pool if s not in taken)
 
-    def fill_duties(self, after=date.today(), am_weight=1.0):  # am_weight: 0-pick PM only; 1-neutral; >1-inclined to picking AM
+        # changed students not needed for the holes go to the emptiest open duty of their session
+        for ampm, pool in [("AM", am_pool), ("PM", pm_pool)]:
+            heap = [(d.n_filled(), i, d) for i, d in enumerate(self.calendar.named(ampm, after))
+                    if d.n_filled() < self.dsp_upper[ampm]]
+            heapq.heapify(heap)
+            for s in pool:
+                popped, duty = [], None
+                while heap:
+                    item = heapq.heappop(heap)
+                    if s.parent in set(x.parent for x in item[2].students):
+                        popped.append(item)
+                        continue
+                    duty = item[2]
+                    break
+                for item in popped: heapq.heappush(heap, item)
+                if duty is None:
+                    _log.error('no %s duty with room for %s, try to increase upper bound', ampm, s)
+                    return False
+                _log.debug('+   %s  to %s (%s)', s, duty.date, duty.name)
+                duty.add(s)
+                if duty.how_many is not None: duty.how_many = duty.n_filled()
+                if duty.n_filled() < self.dsp_upper[ampm]: heapq.heappush(heap, (duty.n_filled(), item[1], duty))
+        return True
+
+    def copy(self):
+        '''return a copy with its own duties, sharing the students'''
+        other = copy.copy(self)
+        other.dsp_lower = OrderedDict(self.dsp_lower)
+        other.dsp_upper = OrderedDict(self.dsp_upper)
+        other.family_limits = dict(self.family_limits)
+        other._tally = self._tally.copy() if self._tally is not None else None   # the queues stay valid
+        other.duties = []
+        for duty in self.duties:
+            d = copy.copy(duty)
+            d.students = list(duty.students)
+            d.tally = other._tally
+            other.duties.append(d)
+        other.calendar = Arrangement.Calendar(other.duties)
+        return other
+
+    # weights of score(): std deviation of the # of students per duty, closeness of a parent's
+    # two duties (1 = same date, 0 = a season apart), and each family with two children on a date
+    score_weights = {'balance': 1.0, 'spread': 10.0, 'sharing': 1.0}
+
+    def score(self, after=date.min):
+        '''return the cost of the duties after a date, the lower the better'''
+        duties = self.calendar.since(after)
+        if not duties: return 0.0
+        balance = 0.0
+        for name in ["AM", "PM"]:
+            ns = [d.n_filled() for d in self.calendar.named(name, after)]
+            if ns:
+                mean = float(sum(ns))/len(ns)
+                balance += math.sqrt(sum((n-mean)**2 for n in ns)/len(ns))
+
+        dates = defaultdict(list)   # parent ==> dates on duty
+        for d in duties:
+            for s in d.students: dates[s.parent].append(d.date)
+        first, last = duties[0].date, duties[-1].date
+        span = float(max((last-first).days, 1))
+        spread, sharing, n = 0.0, 0, 0
+        for ds in dates.itervalues():
+            sharing += len(ds) - len(set(ds))
+            if len(ds) > 1:
+                ds.sort()
+                spread += 1.0 - (ds[-1]-ds[0]).days/span
+                n += 1
+        if n: spread /= n
+        w = Arrangement.score_weights
+        return w['balance']*balance + w['spread']*spread + w['sharing']*sharing
+
+    def _search(self, after, am_weight, solver, trials, workers, seed):
+        '''fill copies of self with trials seeds, keep the best in self, return False if all fail'''
+        rnd = random.Random(seed)
+        seeds = [rnd.randint(0, 2**31-1) for i in range(trials)]
+        args = [(after, am_weight, solver, s) for s in seeds]
+        self._candidate_queues()   # built once, the copies of the trials start from them
+        global _search_base
+        _search_base = self
+        try:
+            if workers > 1:
+                import multiprocessing
+                pool = multiprocessing.Pool(workers)   # forked workers see the loaded tables and self
+                try:
+                    results = pool.map(_run_trial, args, chunksize=1)
+                finally:
+                    pool.terminate()
+            else:
+                results = map(_run_trial, args)
+        finally:
+            _search_base = None
+
+        best = None
+        for seed, ok, score, duties in results:
+            _log.info('seed = %d, %s', seed, 'score = %.3f' % score if ok else 'failed')
+            if ok and (best is None or score < best[2]): best = (seed, ok, score, duties)
+        if best is None:
+            _log.error('all %d trials failed', trials)
+            return False
+
+        self.seed, self.best_score = best[0], best[2]
+        for duty, (how_many, ids) in zip(self.duties, best[3]):
+            duty.how_many = how_many
+            duty.students = [Student.get(id) for id in ids]
+        self._forget_tally()
+        _log.info('best seed = %d, score = %.3f', self.seed, self.best_score)
+        return True
+
+    def fill_duties(self, after=date.today(), am_weight=1.0, solver="greedy", seed=None, trials=1, workers=1):  # am_weight: 0-pick PM only; 1-neutral; >1-inclined to picking AM
+        '''fill open duty spots after a date, return False if it fails
+
+        solver="greedy" fills PJ, bootstrapped and open duties in turn,
+        solver="flow" solves all duties at once as a min-cost flow (see dutyflow.py), am_weight is ignored
+        seed:     seed of the candidate shuffle, kept in self.seed to reproduce the fill
+        trials:   > 1 fills with that many seeds (derived from seed) in workers processes,
+                  and keeps the fill with the lowest score()'''
         if not self.duties:
-            print >> sys.stderr, 'WARNING: There is no duty spot to fill'
+            _log.warning('There is no duty spot to fill')
             return False
+
+        if trials > 1:
+            return self._search(after, am_weight, solver, trials, workers, seed)
+
+        if seed is None: seed = random.SystemRandom().randint(0, 2**31-1)
+        self.seed = seed
+        _log.info('seed = %d', seed)
+
+        if solver == "flow":
+            import dutyflow
+            with instrument.phase('flow_fill'):
+                return dutyflow.fill_duties(self, after, seed)
+        elif solver != "greedy":
+            raise Exception('Unknown solver "%s"' % solver)
             
-        pool = self._collect_avaliable_students()
+        with instrument.phase('pool_build'):
+            pool = self._collect_avaliable_students(seed=seed)
 
-        am_pool = filter(lambda x: x.cls.ampm() == "AM", pool)
-        pm_pool = filter(lambda x: x.cls.ampm() == "PM", pool)
+            am_pool = Arrangement.Pool(s for s in pool if s.cls.ampm() == "AM")
+            pm_pool = Arrangement.Pool(s for s in pool if s.cls.ampm() == "PM")
 
-        print >> sys.stderr, 'INFO: #AM pool = %s' % len(am_pool)
-        print >> sys.stderr, 'INFO: #PM pool = %s' % len(pm_pool)
+        _log.info('#AM pool = %s', len(am_pool))
+        _log.info('#PM pool = %s', len(pm_pool))
 
         #num_am_cands, num_pm_cands = len(am_pool), len(pm_pool)
 
-        # freeze duty spot prior to after date, or with n_filled() >= dsp_upper
-        for duty in self.duties:
-            if duty.date < after:
-                duty.bootstrap(0)  # freeze
-            else:
-                duty.bootstrap(self.dsp_lower[duty.name], self.dsp_upper[duty.name])
+        self._bootstrap_duties(after)
 
         # fill PJ duty
-        for duty in self.duties:
-            if duty.name != "PJ" or duty.isFilled(): continue
-            duty.fill(am_pool, pm_pool, (len(am_pool)*am_weight, len(pm_pool)))  # allocate students from AM pool to PM pool in a ratio
+        with instrument.phase('pj_fill'):
+            for duty in self.calendar.named("PJ"):
+                if duty.isFilled(): continue
+                duty.fill(am_pool, pm_pool, (len(am_pool)*am_weight, len(pm_pool)))  # allocate students from AM pool to PM pool in a ratio
 
         # fill bootstrapped duty
-        for duty in self.duties:
-            if duty.n_spot() is None or duty.isFilled(): continue
-            duty.fill(am_pool, pm_pool, (len(am_pool)*am_weight, len(pm_pool)))
+        with instrument.phase('bootstrapped_fill'):
+            for duty in self.duties:
+                if duty.n_spot() is None or duty.isFilled(): continue
+                duty.fill(am_pool, pm_pool, (len(am_pool)*am_weight, len(pm_pool)))
+
+        with instrument.phase('open_fill'):
+            return self._fill_open_duties(am_pool, pm_pool, after)
 
-        # fill open AM/PM duties
+    def _fill_open_duties(self, am_pool, pm_pool, after):
+        # fill open AM/PM duties, the duties before after are filled by _bootstrap_duties() and the bootstrapped fill
         for ampm, pool in [("AM", am_pool), ("PM", pm_pool)]:
-            open_duties = filter(lambda d: d.name == ampm and not d.isFilled(), self.duties)
+            open_duties = [d for d in self.calendar.named(ampm, after) if not d.isFilled()]
             n_duties = len(open_duties)
             n_left   = len(pool)
             n_filled = sum(d.n_filled() for d in open_duties)
 
             if n_duties == 0 and n_left > 0:
-                print >> sys.stderr, 'ERROR: there are %d %s students not assigned, try to increase upper bound'%(n_left, ampm)
+                _log.error('there are %d %s students not assigned, try to increase upper bound', n_left, ampm)
                 return False
 
             r = float(n_filled + n_left)/float(n_duties)
             lower = self.dsp_lower[ampm]
             upper = self.dsp_upper[ampm]
             if not lower<=r<=upper:
-                print >> sys.stderr, 'ERROR: average # of %s students is %f, outside range [%d,%d]'%(ampm, r, lower, upper)
+                _log.error('average # of %s students is %f, outside range [%d,%d]', ampm, r, lower, upper)
                 return False
 
             for duty, piece in zip(open_duties, _slice(n_duties, n_filled+n_left)):
@@ -686,8 +1513,25 @@ class Arrangement:
                 try:
                     duty.fill(pool, pool)
                 except Arrangement.NoEnoughStudent as err:  # possible false complaint
+                    instrument.count('no_enough_student')
                     if duty.n_filled() < lower:
-                        print >> sys.stderr, 'ERROR: unable to fill %d %s duty spots, no enough students' % (err.deficit, duty.name)
+                        _log.error('unable to fill %d %s duty spots, no enough students', err.deficit, duty.name)
                         return False
                 
         return True
+
+# arrangement filled by _run_trial(), set by Arrangement._search() before the workers fork
+_search_base = None
+
+def _run_trial(args):
+    '''fill a copy of _search_base with a seed, return (seed, ok, score, [(how_many, [student IDs])])'''
+    after, am_weight, solver, seed = args
+    asgm = _search_base.copy()
+    disabled = logging.root.manager.disable   # the level disabled by the caller, if any
+    logging.disable(logging.CRITICAL)   # _search() reports the outcome of each trial
+    try:
+        ok = asgm.fill_duties(after, am_weight, solver, seed)
+    finally:
+        logging.disable(disabled)
+    duties = [(d.how_many, [s.id for s in d.students]) for d in asgm.duties]
+    return seed, ok, asgm.score(after) if ok else None, duties
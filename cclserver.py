@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# query server keeping the CCL tables in memory for the front desk tools
+#
+# One JSON request per line, one JSON reply per line, over a Unix socket or a localhost TCP
+# port, e.g. {"q": "roster", "class": "B1A"}.  Replies are read from a Snapshot, indexes of the
+# tables built once per load, so a query is a few dict lookups.  A background thread polls the
+# registration csv (and the arrangement) and loads a new Snapshot when they change, the old
+# one answers until the new one is complete.  Replies are kept per request line, so a repeated
+# query is not encoded again.
+import getopt, sys, os, json, time, socket, threading, logging, subprocess, SocketServer
+from collections import defaultdict
+import ccl
+from ccl import *
+
+_log = logging.getLogger('ccl.server')
+
+def _student_info(s):
+    return {'id': s.id, 'name': s.name, 'chinese_name': s.chinesename or '', 'class': s.cls.name,
+            'culture': s.culture.name if s.culture else None, 'status': s.status, 'active': s.isActive(),
+            'pod': s.pod}
+
+def _check_info(check):
+    if check is None: return None
+    return {'amount': check.amt, 'no': check.no, 'status': check.status}
+
+class Snapshot(object):
+    '''read-only indexes of the tables loaded from a registration csv and an optional arrangement'''
+    def __init__(self, csvfile, cstfile=None, cache=True):
+        self.csvfile, self.cstfile = csvfile, cstfile
+        self.stamp = Snapshot.stamp(csvfile, cstfile)
+        t0 = time.time()
+        ccl.reset()
+        for err in ccl.init(csvfile, skip_errors=True, cache=cache):   # a bad row is skipped, not the whole load
+            _log.warning('%s: %s', csvfile, err)
+
+        self.students = {}                      # ID ==> student info
+        self.by_name  = defaultdict(list)       # lower case name ==> [student info]
+        self.classes  = defaultdict(list)       # lower case class name ==> [student info], by name
+        self.families = {}                      # family key ==> family info
+        self.by_parent = defaultdict(list)      # lower case mom or dad name ==> [family info]
+        self.tuition  = {}                      # ID ==> checks
+        for p in Parent.all():
+            family = {'mom': p.mom, 'dad': p.dad, 'phones': sorted(p.phones), 'emails': sorted(p.emails),
+                      'children': []}
+            self.families[p.key] = family
+            for name in p.key:
+                if name: self.by_parent[name.lower()].append(family)
+        for s in sorted(Student.all(), key=lambda s: s.id):
+            info = _student_info(s)
+            if s.parent is not None:
+                family = self.families[s.parent.key]
+                family['children'].append(info)
+                info['family'] = {'mom': family['mom'], 'dad': family['dad'],
+                                  'phones': family['phones'], 'emails': family['emails']}
+            self.students[s.id] = info
+            self.by_name[s.name.lower()].append(info)
+            for cls in [s.cls, s.culture]:
+                if cls is not None: self.classes[cls.name.lower()].append(info)
+            self.tuition[s.id] = {'student': s.name, 'class': s.cls.name, 'tuition': _check_info(s.tuition_check),
+                                  'pod': _check_info(s.pod_check), 'donation': _check_info(s.donation_check)}
+        for ss in self.classes.values(): ss.sort(key=lambda info: info['name'])
+
+        self.duties = defaultdict(list)         # YYYY-MM-DD ==> [duty info]
+        self.diagnostics = []
+        if cstfile:
+            asgm = Arrangement()
+            self.diagnostics = [str(d) for d in asgm.load(cstfile, strict=False)]
+            for dt in asgm.calendar.dates:
+                self.duties[str(dt)] = [{'name': d.name, 'students': [self.students[s.id] for s in d.students]}
+                                        for d in asgm.calendar.on(dt)]
+        self.loaded = time.time()
+        self.load_seconds = self.loaded - t0
+        self._replies = {}   # request line ==> reply line
+
+    def reply(self, line):
+        '''return the JSON reply line of a JSON request line'''
+        r = self._replies.get(line)
+        if r is None:
+            try:
+                r = json.dumps(self.answer(json.loads(line))) + '\n'
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                r = json.dumps({'error': '%s: %s' % (type(err).__name__, err)}) + '\n'
+            if len(self._replies) < 100000: self._replies[line] = r
+        return r
+
+    @staticmethod
+    def stamp(*files):
+        '''return (size, mtime) of the files, to tell if they changed'''
+        r = []
+        for fn in files:
+            if fn is None: continue
+            try:
+                st = os.stat(fn)
+                r.append( (st.st_size, st.st_mtime) )
+            except OSError:
+                r.append(None)
+        return tuple(r)
+
+    def answer(self, req):
+        '''return the reply of a request dict'''
+        if not isinstance(req, dict): raise TypeError('request is not a JSON object')
+        q = req.get('q')
+        if q == 'student':
+            if 'id' in req:
+                info = self.students.get(int(req['id']))
+                return {'students': [info] if info else []}
+            return {'students': self.by_name.get(ccl._proc_name(req['name']).lower(), [])}
+        elif q == 'roster':
+            students = self.classes.get(req['class'].strip().lower(), [])
+            if not req.get('all'): students = [s for s in students if s['active']]
+            return {'class': req['class'], 'students': students}
+        elif q == 'family':
+            if 'id' in req:
+                info = self.students.get(int(req['id']))
+                return {'families': [info['family']] if info and 'family' in info else []}
+            return {'families': self.by_parent.get(ccl._proc_name(req['name']).lower(), [])}
+        elif q == 'tuition':
+            if 'id' in req:
+                t = self.tuition.get(int(req['id']))
+                return {'checks': [t] if t else []}
+            return {'checks': [self.tuition[s['id']] for s in self.classes.get(req['class'].strip().lower(), [])]}
+        elif q == 'duty':
+            return {'date': req['date'], 'duties': self.duties.get(req['date'], [])}
+        elif q == 'status':
+            return {'csv': self.csvfile, 'cst': self.cstfile, 'students': len(self.students),
+                    'families': len(self.families), 'loaded': self.loaded, 'load_seconds': round(self.load_seconds, 3),
+                    'diagnostics': self.diagnostics}
+        raise ValueError('unknown query %r' % q)
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line: break
+            line = line.strip()
+            if not line: continue
+            self.wfile.write(self.server.snapshot.reply(line))
+            self.wfile.flush()
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def _warm_cache(csvfile):
+    '''parse csvfile into its cached snapshot in another process, so this one only loads the snapshot'''
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable, '-c', 'import ccl; ccl.init(%r, cache=True)' % os.path.abspath(csvfile)],
+                        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+
+def serve(address, csvfile, cstfile=None, poll=2.0, cache=True):
+    '''serve queries on address (a Unix socket path, or a (host, port) pair) until interrupted'''
+    snapshot = Snapshot(csvfile, cstfile, cache)
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _Handler)
+    else:
+        if os.path.exists(address): os.unlink(address)
+        server = _UnixServer(address, _Handler)
+    server.snapshot = snapshot
+    _log.info('serving %d students on %s', len(snapshot.students), address)
+
+    def reload():
+        last = failed = None
+        while True:
+            time.sleep(poll)
+            stamp = Snapshot.stamp(csvfile, cstfile)
+            last, previous = stamp, last
+            # wait for the files to stay the same for a poll, they may be still being written
+            if stamp in [server.snapshot.stamp, failed] or stamp != previous: continue
+            try:
+                if cache: _warm_cache(csvfile)
+                new = Snapshot(csvfile, cstfile, cache)
+            except Exception as err:   # keep serving the old snapshot until the next change
+                _log.error('reload of %s failed: %s', csvfile, err)
+                failed = stamp
+                continue
+            server.snapshot = new
+            _log.info('reloaded %d students in %.3f s', len(new.students), new.load_seconds)
+    if poll > 0:
+        t = threading.Thread(target=reload)
+        t.daemon = True
+        t.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address): os.unlink(address)
+
+def connect(address):
+    '''return a socket connected to a server at address'''
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def query(sock, **request):
+    '''send a request on a connected socket, return the reply dict'''
+    sock.sendall(json.dumps(request) + '\n')
+    buf = []
+    while True:
+        data = sock.recv(65536)
+        if not data: raise IOError('connection closed by server')
+        buf.append(data)
+        if data.endswith('\n'): break
+    return json.loads(''.join(buf))
+
+def usage():
+    print \
+        '''%s --csv <registration csv> [--cst <pod arrangement>] [--socket <path> | --port <n>] [--poll <seconds>] [--no-cache]
+        %s [--socket <path> | --port <n>] --query <student|roster|family|tuition|duty|status> [<key>=<value> ...]
+        --socket, Unix socket of the server, default ./ccl.sock
+        --port,   serve on this localhost TCP port instead
+        --poll,   check the files for changes every this many seconds, default 2, 0 for never
+        --query,  ask a running server, e.g. --query roster class=B1A, --query student name="Josh Huang",
+                  --query family name="Amy Wang", --query tuition id=12, --query duty date=2015-09-12''' % (sys.argv[0], sys.argv[0])
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['csv=', 'cst=', 'socket=', 'port=', 'poll=', 'no-cache', 'query=', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile = cstfile = q = None
+    address, poll, cache = 'ccl.sock', 2.0, True
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--cst':
+            cstfile = v
+        elif o == '--socket':
+            address = v
+        elif o == '--port':
+            address = ('127.0.0.1', int(v))
+        elif o == '--poll':
+            poll = float(v)
+        elif o == '--no-cache':
+            cache = False
+        elif o == '--query':
+            q = v
+
+    if q:
+        request = dict(a.split('=', 1) for a in args)
+        request['q'] = q
+        print json.dumps(query(connect(address), **request), indent=2)
+        return
+
+    if csvfile is None:
+        print >> sys.stderr, 'Missing student registration csv'
+        usage()
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    try:
+        serve(address, csvfile, cstfile, poll, cache)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,21 @@
 #!/usr/bin/python
 import getopt, sys
-import ccl
+import ccl, columnar
 from ccl import *
-from collections import defaultdict
 
 def usage():
-    print '%s --class <classname, eg. B1P> --csv <csv of student registration sheet>' % sys.argv[0]
+    print '%s --class <classname, eg. B1P> --csv <csv of student registration sheet> [--no-cache]' % sys.argv[0]
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'h', ['class=', 'csv=', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['class=', 'csv=', 'help', 'no-cache'])
     except getopt.GetoptError as err:
         print str(err)
         usage()
         sys.exit(1)
 
     csvfile, classname = None, None
+    cache = True
     for o, v in opts:
         if o in ['-h', '--help']:
             usage()
@@ -24,37 +24,37 @@ def main():
             classname = v
         elif o == '--csv':
             csvfile = v
+        elif o == '--no-cache':
+            cache = False
 
-    
-    bucket = defaultdict(list)    
-    students = []
-    ccl.init(csvfile)
-    for cls in [Class.get(cname) for cname in classname.split(',')]:
-        if not cls:
-            print >> sys.stderr, 'Unknow classname %s'%classname
-            sys.exit(1)
-        students += filter(lambda s: s.isActive(), cls.students)
-
-    print '######## %s ########'%classname
-    total_amt = 0
-    total_students = 0
-    for s in students:
-        check = s.tuition_check
-        total_amt += check.amt
-        total_students += 1
-        bucket[check.amt].append(s)
 
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=['checks', 'culture']):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    try:
+        classes = [Class.get(cname) for cname in classname.split(',')]
+    except KeyError:
+        print >> sys.stderr, 'Unknow classname %s'%classname
+        sys.exit(1)
+    write_tuition(sys.stdout, classes, classname)
+
+def write_tuition(fh, classes, title):
+    '''write the tuition checks of the active students of classes bucketed by amount'''
+    cols = columnar.StudentColumns([s for cls in classes for s in cls.students])
+    active = cols.mask(active=1)
+
+    print >> fh, '######## %s ########'%title
+    bucket = cols.count_by('tuition', active)
     for amt in sorted(bucket):
-        ss = bucket[amt]
-        print '$%d [%d]'%(amt, len(ss))
+        ss = cols.students(cols.mask(active=1, tuition=amt))
+        print >> fh, '$%d [%d]'%(amt, len(ss))
         for s in ss:
             check = s.tuition_check
-            print '\t%12s  #%4s  %s' % (check.status, check.no, repr(s))
-        print
+            print >> fh, '\t%12s  #%4s  %s' % (check.status, check.no, repr(s))
+        print >> fh
 
-    print 'Total Amount = $%d' % total_amt
-    print 'Total Student = %d' % total_students
-    print
+    print >> fh, 'Total Amount = $%d' % cols.sum('tuition', active)
+    print >> fh, 'Total Student = %d' % cols.count(active)
+    print >> fh
 
 if __name__ == "__main__":
     main()
@@ -1,22 +1,29 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import getopt, sys, codecs
+import getopt, sys, codecs, csv
 import ccl
 from ccl import *
 
 def usage():
-    print '%s --class <language|culture|classname, eg. B1P, Dance> --csv <csv of student registration sheet>' % sys.argv[0]
+    print \
+        '''%s --class <language|culture|all|classname, eg. B1P, Dance> --csv <csv of student registration sheet> [--no-cache]
+        [--format <text|csv|tsv>] [--output <file>]
+        --format, text is the fixed width roster with the emails of each class (default),
+                  csv and tsv have a row per active student: class, Chinese name, name, phones, emails
+        --output, write to this file instead of stdout''' % sys.argv[0]
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'h', ['class=', 'csv=', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['class=', 'csv=', 'format=', 'output=', 'help', 'no-cache'])
     except getopt.GetoptError as err:
         print str(err)
         usage()
         sys.exit(1)
 
-    csvfile, classname = None, None
+    csvfile, classname, output = None, None, None
+    fmt = 'text'
+    cache = True
     for o, v in opts:
         if o in ['-h', '--help']:
             usage()
@@ -25,48 +32,108 @@ def main():
             classname = v
         elif o == '--csv':
             csvfile = v
+        elif o == '--format':
+            fmt = v
+        elif o == '--output':
+            output = v
+        elif o == '--no-cache':
+            cache = False
 
-    if not sys.stdout.isatty():
-        sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-        
-    ccl.init(csvfile)
-    classes = []
-    # collect classes of interest
-    if classname.lower() == "language":
-        classes = [cls for cls in Class.all() if cls.isLanguageClass()]
+    if fmt != 'text' and fmt not in _dialects:
+        print >> sys.stderr, 'Unknown format %s' % fmt
+        usage()
+        sys.exit(1)
+
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=['contacts', 'culture']):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    try:
+        classes = select_classes(classname)
+    except KeyError as err:
+        print >> sys.stderr, 'Unknow classname %s'%err.args[0]
+        sys.exit(1)
+
+    fh = open(output, 'wb', 1<<16) if output else sys.stdout
+    try:
+        if fmt != 'text':
+            write_roster_table(fh, classes, fmt)
+        else:
+            if output or not sys.stdout.isatty(): fh = codecs.getwriter('utf8')(fh)
+            write_roster(fh, classes)
+    finally:
+        if output: fh.close()
+
+def select_classes(classname):
+    '''return the classes of "all", "language", "culture" or comma separated class names, raise KeyError for an unknown name'''
+    if classname.lower() == "all":
+        return Class.all()
+    elif classname.lower() == "language":
+        return [cls for cls in Class.all() if cls.isLanguageClass()]
     elif classname.lower() == "culture":
-        classes = [cls for cls in Class.all() if cls.isCultureClass()]
-    else:
-        classes = []
-        for clsnm in classname.split(','):
-            cls = Class.get(clsnm.strip())
-            if not cls:
-                cls = Class.get(clsnm.lower().strip())
-                if not cls:
-                    print >> sys.stderr, 'Unknow classname %s'%clsnm
-                    sys.exit(1)
-            classes.append(cls)
+        return [cls for cls in Class.all() if cls.isCultureClass()]
+    by_name = dict((cls.name, cls) for cls in Class.all())
+    by_lower = dict((cls.name.lower(), cls) for cls in Class.all())
+    classes = []
+    for clsnm in classname.split(','):
+        cls = by_name.get(clsnm.strip()) or by_lower.get(clsnm.lower().strip())
+        if not cls: raise KeyError(clsnm)
+        classes.append(cls)
+    return classes
 
-    # output contact info class by class
+_no_cname = ('', '%-8s' % '')   # Chinese name and fixed width Chinese name of a student without one
+
+class Contacts(object):
+    '''contact strings of the loaded students, formatted once however many classes list a student or a family'''
+    def __init__(self):
+        self._parents = {}   # parent ==> (phones, emails)
+        self._rows    = {}   # student ==> row
+
+    def rows(self, cls):
+        '''return [(student, Chinese name, fixed width Chinese name, phones, emails)] of the active students of cls'''
+        parents, cache = self._parents, self._rows
+        rows = []
+        for s in cls.students:
+            row = cache.get(s)
+            if row is None:
+                if s.chinesename:
+                    cname = s.cname
+                    name = (cname.rstrip(), cname)
+                else:
+                    name = _no_cname
+                contact = parents.get(s.parent)
+                if contact is None: contact = parents[s.parent] = (s.parent.phones_str, s.parent.emails_str)
+                row = cache[s] = (s,) + name + contact
+            if s.isActive(): rows.append(row)
+        return rows
+
+def write_roster(fh, classes, contacts=None):
+    '''write contact info of the active students class by class'''
+    if contacts is None: contacts = Contacts()
     header =   '%s * %-25s * %-32s * %-30s' % (u'学生中文名', u'学生英文名', u'电话', "email")
     fmt    = '%s   * %-30s * %-34s * %-30s'
+    out = []
     for cls in classes:
+        rows = contacts.rows(cls)
+        if not rows: continue
         email_list = set()
-        roster = []
-        for s in cls.students:
-            if not s.isActive(): continue
-            email_list |= s.parent.emails
-            roster.append( fmt % (s.cname, s.name, s.parent.phones_str, s.parent.emails_str) )
+        for row in rows: email_list |= row[0].parent.emails
+        out.append('--- CLASS %s ---\n' % cls.name)
+        out.append(header + '\n')
+        out.extend(fmt % (cname, s.name, phones, emails) + '\n' for s, name, cname, phones, emails in rows)
+        out.append('\nAll email: ' + ','.join(list(email_list)) + '\n')
+        out.append('\n\n')
+    fh.write(''.join(out))
+
+# --format of write_roster_table() ==> csv.writer parameters
+_dialects = {'csv': {}, 'tsv': {'delimiter': b'\t'}}
+
+def write_roster_table(fh, classes, fmt='csv', contacts=None):
+    '''write a utf-8 csv (or tsv) row per active student of the classes to a binary file'''
+    if contacts is None: contacts = Contacts()
+    writer = csv.writer(fh, lineterminator=b'\n', **_dialects[fmt])
+    writer.writerow([b'Class', b'Chinese name', b'Name', b'Phones', b'Emails'])
+    for cls in classes:
+        writer.writerows([(cls.name, name.encode('utf-8'), s.name, phones, emails)
+                          for s, name, cname, phones, emails in contacts.rows(cls)])
 
-        if roster:
-            print '--- CLASS %s ---'%cls.name
-            print header
-            print '\n'.join(roster)
-            print '\nAll email: ' + ','.join(list(email_list))
-            print '\n'
-    
 if __name__ == "__main__":
     main()
-    
-    
-
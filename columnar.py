@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# columnar view of the loaded CCL tables for aggregate reporting
+#
+# Every student is a row, every column is a flat array (array.array or bytearray), strings are
+# stored as integer codes into a per-column table, in a bytearray while they fit in a byte.
+# Filters build a 0/1 bytearray mask, masks are combined as big integers, and aggregates walk
+# the columns with C-level iterators (itertools.compress, izip), so queries over 100k
+# registrations take milliseconds.  numpy() exports the columns if numpy is installed.
+from array import array
+from itertools import compress, izip
+from collections import defaultdict
+from binascii import hexlify, unhexlify
+import ccl
+
+# coded columns, the code of a value is its index in StudentColumns.tables[column]
+_coded = ['cls', 'session', 'status', 'tuition_status', 'pod_status', 'donation_status']
+
+def _narrow(codes, n):
+    '''return codes of a table of n values as a bytearray, or an array of the smallest type holding them'''
+    if n <= 0x100: return bytearray(codes.tolist())
+    return array('H' if n <= 0x10000 else 'l', codes)
+
+def _and(a, b):
+    '''return the rows set in both 0/1 masks a and b, the masks are and-ed as two big integers'''
+    if not a: return bytearray()
+    return bytearray(unhexlify('%0*x' % (2*len(a), int(hexlify(a), 16) & int(hexlify(b), 16))))
+
+class StudentColumns:
+    def __init__(self, students=None):
+        '''build the columns of students, default all loaded students'''
+        if students is None: students = ccl.Student.all()
+        self.tables = dict((c, []) for c in _coded)
+        self.tables['parent'] = []
+        codes = dict((c, {}) for c in self.tables)
+        def code(column, value):
+            cs = codes[column]
+            if value not in cs:
+                cs[value] = len(self.tables[column])
+                self.tables[column].append(value)
+            return cs[value]
+        for column in ['tuition_status', 'pod_status', 'donation_status']:
+            code(column, None)   # code 0 is no check
+
+        self.id       = array('l')
+        self.cls      = array('l')   # the coded columns are narrowed by _narrow() once all are coded
+        self.session  = array('l')
+        self.grade    = array('h')   # -1 for no grade
+        self.status   = array('l')
+        self.active   = bytearray()
+        self.pod      = bytearray()
+        self.parent   = array('l')   # -1 for no parent
+        self.tuition  = array('l')
+        self.pod_amt  = array('l')
+        self.donation = array('l')
+        self.tuition_status  = array('l')
+        self.pod_status      = array('l')
+        self.donation_status = array('l')
+        for s in students:
+            self.id.append(s.id)
+            self.cls.append(code('cls', s.cls.name))
+            self.session.append(code('session', s.cls.ampm()))
+            grade = s.cls.info.grade
+            self.grade.append(-1 if grade is None else grade)
+            self.status.append(code('status', s.status))
+            self.active.append(s.isActive())
+            self.pod.append(s.pod)
+            self.parent.append(-1 if s.parent is None else code('parent', s.parent))
+            for amt, status, check in [(self.tuition, 'tuition_status', s.tuition_check),
+                                       (self.pod_amt, 'pod_status', s.pod_check),
+                                       (self.donation, 'donation_status', s.donation_check)]:
+                amt.append(check.amt if check else 0)
+                getattr(self, status).append(code(status, check.status) if check else 0)
+        for column in _coded:
+            setattr(self, column, _narrow(getattr(self, column), len(self.tables[column])))
+
+    def __len__(self): return len(self.id)
+
+    def mask(self, **conditions):
+        '''return 0/1 bytearray of the rows matching all conditions, column=value or column=[values];
+        coded columns are matched by value, e.g. mask(active=1, session="AM", cls=["B1A", "B1P"])'''
+        m = None
+        for column, value in conditions.iteritems():
+            col = getattr(self, column)
+            if not isinstance(value, (list, tuple, set, frozenset)): value = [value]
+            if column in self.tables:
+                table = self.tables[column]
+                value = [table.index(v) for v in value if v in table]
+            if isinstance(col, bytearray):   # byte columns: one translate() call
+                lut = bytearray(256)
+                for v in value: lut[int(v)] = 1
+                cm = col.translate(lut)
+            else:
+                cm = bytearray(map(set(value).__contains__, col))
+            m = cm if m is None else _and(m, cm)
+        if m is None: m = bytearray(b'\x01') * len(self)
+        return m
+
+    def count(self, mask=None):
+        if mask is None: return len(self)
+        return mask.count(b'\x01')
+
+    def sum(self, column, mask=None):
+        col = getattr(self, column)
+        if mask is None: return sum(col)
+        return sum(compress(col, mask))
+
+    def _decode(self, column, code):
+        if column in self.tables: return self.tables[column][code]
+        return code
+
+    def count_by(self, key, mask=None):
+        '''return {key value: # of rows}'''
+        keys = getattr(self, key)
+        if mask is not None: keys = compress(keys, mask)
+        r = defaultdict(int)
+        for k in keys: r[k] += 1
+        return dict((self._decode(key, k), n) for k, n in r.iteritems())
+
+    def sum_by(self, key, column, mask=None):
+        '''return {key value: sum of column}'''
+        rows = izip(getattr(self, key), getattr(self, column))
+        if mask is not None: rows = compress(rows, mask)
+        r = defaultdict(int)
+        for k, v in rows: r[k] += v
+        return dict((self._decode(key, k), v) for k, v in r.iteritems())
+
+    def students(self, mask):
+        '''return the students of the masked rows'''
+        return [ccl.Student.get(i) for i in compress(self.id, mask)]
+
+    def numpy(self):
+        '''return {column: numpy array}, numpy is only needed for this'''
+        import numpy
+        columns = ['id', 'cls', 'session', 'grade', 'status', 'active', 'pod', 'parent', 'tuition',
+                   'pod_amt', 'donation', 'tuition_status', 'pod_status', 'donation_status']
+        r = {}
+        for c in columns:
+            col = getattr(self, c)
+            r[c] = numpy.frombuffer(col, dtype=numpy.uint8) if isinstance(col, bytearray) else numpy.array(col)
+        return r
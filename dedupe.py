@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# find families registered more than once under name or contact variants
+#
+# Parent merges families only when (mom, dad) match exactly, so "Li Wang" and "Wang Li", or
+# a family without the dad's name, become separate parents and the one child per family
+# rules of the POD fill no longer hold.  Families are put in blocks by normalized phone,
+# email and parent names (their words in any order, mom and dad in any order), a family with
+# one name also in the block of each family with that name.  Only families of a block are
+# compared, so the cost is about linear in the # of families.  Families sharing a phone or
+# an email whose names agree, or with the same two names where one has no phone or email,
+# are merged, other candidates are only flagged for the office to check.  Adult students are
+# their own family and left alone.
+import getopt, sys, re, logging
+from collections import namedtuple, defaultdict
+import ccl
+from ccl import *
+
+_log = logging.getLogger('ccl.dedupe')
+
+# a pair of families of a block, action is "merge" or "flag"
+Candidate = namedtuple('Candidate', ['a', 'b', 'action', 'reason'])
+
+def _phone_key(phone):
+    digits = re.sub(r'\D', '', phone)
+    if len(digits) == 11 and digits[0] == '1': digits = digits[1:]
+    return digits if len(digits) >= 7 else None
+
+def _email_key(email):
+    email = email.lower().replace('mailto:', '').strip()
+    return email if '@' in email else None
+
+def _name_key(name):
+    '''"Li  Wang", "wang li" ==> "li wang"'''
+    return ' '.join(sorted(name.lower().replace(',', ' ').split()))
+
+def _compare(a, b, names, contacts):
+    '''return the Candidate of families a and b, None if they do not match'''
+    na, nb = names[a], names[b]
+    common = na & nb
+    compatible = bool(common) and (na <= nb or nb <= na)   # same names, or one family misses a name
+    shared = contacts[a] & contacts[b]
+    if shared and compatible:
+        return Candidate(a, b, 'merge', 'same %s and %s' % (' and '.join(sorted(common)), sorted(shared)[0][1]))
+    if compatible and len(common) == 2 and not (contacts[a] and contacts[b]):
+        return Candidate(a, b, 'merge', 'same parents %s' % ' and '.join(sorted(common)))
+    if shared:
+        return Candidate(a, b, 'flag', 'same %s, different names' % sorted(shared)[0][1])
+    if compatible:
+        return Candidate(a, b, 'flag', 'same %s, no phone or email in common' % ' and '.join(sorted(common)))
+    return None
+
+def find_duplicates(parents=None, max_block=50):
+    '''return [Candidate] of the families (default all) of the same blocks
+
+    A block of more than max_block families, e.g. a phone shared by an office, is skipped.'''
+    if parents is None: parents = Parent.all()
+    names, contacts = {}, {}
+    blocks  = defaultdict(list)   # blocking key ==> families
+    by_name = defaultdict(list)   # name key ==> families with the name
+    singles = set()               # name keys of the families with one name
+    for p in parents:
+        if p.mom == p.dad: continue    # adult student
+        ns = names[p] = set(_name_key(n) for n in p.key if n)
+        cs = contacts[p] = set(k for k in [('phone', _phone_key(x)) for x in p.phones] +
+                                          [('email', _email_key(x)) for x in p.emails] if k[1])
+        for key in cs: blocks[key].append(p)
+        blocks[('names',) + tuple(sorted(ns))].append(p)
+        for name in ns: by_name[name].append(p)
+        if len(ns) == 1: singles |= ns
+    for name in singles: blocks[('name', name)] = by_name[name]
+
+    candidates, seen = [], set()
+    for key, ps in blocks.iteritems():
+        if len(ps) < 2: continue
+        elif len(ps) > max_block:
+            _log.info('skip block %s of %d families', key, len(ps))
+            continue
+        for i, a in enumerate(ps):
+            for b in ps[i+1:]:
+                if key[0] == 'name' and len(names[a]) == len(names[b]) == 2: continue
+                pair = (a, b) if id(a) < id(b) else (b, a)
+                if pair in seen: continue
+                seen.add(pair)
+                c = _compare(a, b, names, contacts)
+                if c: candidates.append(c)
+    return candidates
+
+def _first_child(p):
+    return min(s.id for s in p.children) if p.children else sys.maxint
+
+def group_duplicates(candidates):
+    '''return [(family to keep, [families to merge into it])] of the "merge" candidates
+
+    Of a group of matching families, the one with both names, then most children, is kept.'''
+    group = {}    # family ==> its group, a list shared by its members
+    for c in candidates:
+        if c.action != 'merge': continue
+        ga, gb = group.get(c.a), group.get(c.b)
+        if ga is None and gb is None:
+            g = [c.a, c.b]
+        elif ga is None or gb is None:
+            g = ga or gb
+            g.append(c.a if ga is None else c.b)
+        elif ga is gb:
+            continue
+        else:
+            g = ga + gb
+        for p in g: group[p] = g
+
+    groups = dict((id(g), g) for g in group.itervalues()).values()
+    for g in groups: g.sort(key=lambda p: (-bool(p.mom and p.dad), -len(p.children), _first_child(p)))
+    return [(g[0], g[1:]) for g in sorted(groups, key=lambda g: min(_first_child(p) for p in g))]
+
+def merge_duplicates(candidates):
+    '''merge the families of the "merge" candidates, return [(kept family, [merged families])]'''
+    merged = group_duplicates(candidates)
+    for keep, others in merged:
+        for other in others:
+            _log.info('merge %r into %r', other, keep)
+            Parent.merge(keep, other)
+    return merged
+
+def usage():
+    print \
+        '''%s --csv <registration csv> [--no-cache] [--flagged]
+        print the families that would be merged before a POD fill (podutil.py --dedupe),
+        --flagged, also print the candidates left for the office to check''' % sys.argv[0]
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['csv=', 'no-cache', 'flagged', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile, cache, flagged = None, True, False
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--no-cache':
+            cache = False
+        elif o == '--flagged':
+            flagged = True
+
+    if csvfile is None:
+        print >> sys.stderr, 'Missing student registration csv'
+        usage()
+        sys.exit(1)
+
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=['contacts']):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    candidates = find_duplicates()
+    for c in candidates:
+        if c.action == 'merge' or flagged:
+            print '%-5s %r, %r: %s' % (c.action, c.a, c.b, c.reason)
+    merged = group_duplicates(candidates)
+    print '%d families merged into %d, %d candidates flagged' % (
+        sum(len(others) for keep, others in merged), len(merged), sum(1 for c in candidates if c.action == 'flag'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# fill POD duty spots by solving a min-cost flow, an alternative to the greedy passes of Arrangement.fill_duties
+#
+# Step 1 decides how many candidates of each kind go to each group of duties.  Candidates of the
+# same kind (session, PJ qualification, prio) are interchangeable for counting, and duties of the
+# same name and state (fixed # of spots, or open within [dsp_lower, dsp_upper]) form one group,
+# so the flow network has only a few dozen nodes whatever the size of the school.  A family may
+# take one spot of a duty: a family with more candidates for a group than duties of the group
+# it is not on yet is a kind of its own, reaching the group through a node of that capacity.
+#
+# Step 2 places the chosen candidates on the duties of each group by a max flow of its own,
+# kind ==> family ==> duty ==> sink, where a family reaches a duty it is not on through an edge
+# of capacity 1.  Candidates go to the emptiest duty first, augmenting paths of the residual
+# network place the ones left, the spots that have to be filled before the others.
+import heapq, logging
+from collections import OrderedDict, defaultdict
+import instrument
+
+_log = logging.getLogger('ccl.dutyflow')
+
+def _costs(prios):
+    '''return ({prio: cost of leaving a candidate of the prio without duty}, cost of a spot that has to be filled)
+
+    Each prio costs 100 times the next one, filling a spot that has to be filled beats them all.'''
+    top = max(prios) + 1 if prios else 1
+    return dict((prio, 100 ** (top - prio)) for prio in prios), -100 ** (top + 1)
+
+class _Graph:
+    '''flow network for successive shortest path min-cost flow'''
+    def __init__(self):
+        self.adj = []    # node ==> [edge index]
+        self.to, self.cap, self.cost = [], [], []
+
+    def node(self):
+        self.adj.append([])
+        return len(self.adj)-1
+
+    def edge(self, u, v, cap, cost=0):
+        '''add edge u->v, return its index for flow()'''
+        e = len(self.to)
+        for a, b, c, w in [(u, v, cap, cost), (v, u, 0, -cost)]:  # edge e^1 is the residual of edge e
+            self.adj[a].append(len(self.to))
+            self.to.append(b)
+            self.cap.append(c)
+            self.cost.append(w)
+        return e
+
+    def flow(self, e): return self.cap[e^1]
+
+    def min_cost_flow(self, s, t):
+        '''send as much flow as possible from s to t at the minimum cost, edge costs may be negative'''
+        n = len(self.adj)
+        total = 0
+        while True:
+            # Bellman-Ford with a queue, the network is tiny
+            dist, prev, inq = [None]*n, [None]*n, [False]*n
+            dist[s] = 0
+            queue = [s]
+            while queue:
+                u = queue.pop()
+                inq[u] = False
+                for e in self.adj[u]:
+                    if self.cap[e] <= 0: continue
+                    v, d = self.to[e], dist[u] + self.cost[e]
+                    if dist[v] is None or d < dist[v]:
+                        dist[v], prev[v] = d, e
+                        if not inq[v]:
+                            inq[v] = True
+                            queue.append(v)
+            if dist[t] is None: return total
+
+            f, v = None, t
+            while v != s:
+                e = prev[v]
+                f = self.cap[e] if f is None else min(f, self.cap[e])
+                v = self.to[e^1]
+            v = t
+            while v != s:
+                e = prev[v]
+                self.cap[e]   -= f
+                self.cap[e^1] += f
+                v = self.to[e^1]
+            total += f
+
+def _eligible(duty, student):
+    if duty.name in ["AM", "PM"] and student.cls.ampm() != duty.name: return False
+    return duty.is_student_qualified(student)
+
+class _Group:
+    '''duties of the same name that are either all fixed or all open'''
+    def __init__(self, name, is_open, lower, upper):
+        self.name, self.is_open = name, is_open
+        self.lower, self.upper = lower, upper   # per duty bounds of open duties
+        self.duties = []
+
+    def __repr__(self): return '%s(%s)' % (self.name, 'open' if self.is_open else 'fixed')
+
+    def need(self, duty):
+        '''# of spots of duty that must be filled'''
+        if self.is_open: return max(0, self.lower - duty.n_filled())
+        return duty.n_spot()
+
+    def room(self, duty):
+        '''# of spots of duty that may be filled'''
+        if self.is_open: return max(0, self.upper - duty.n_filled())
+        return duty.n_spot()
+
+def _groups(asgm):
+    groups = OrderedDict()
+    for duty in asgm.duties:
+        if duty.isFilled(): continue
+        is_open = duty.n_spot() is None
+        key = (duty.name, is_open)
+        if key not in groups:
+            groups[key] = _Group(duty.name, is_open, asgm.dsp_lower[duty.name], asgm.dsp_upper[duty.name])
+        groups[key].duties.append(duty)
+    # fixed spots first, like the greedy passes
+    return sorted(groups.values(), key=lambda g: (g.is_open, g.name != "PJ"))
+
+class _Placer:
+    '''places quota[kind] candidates of each kind on the duties of a group, one child of a family on a duty
+
+    kinds[kind] holds the unused candidates in reverse selection order, shared by the groups.'''
+    def __init__(self, group, kinds, kind_of, quota):
+        self.kinds, self.kind_of = kinds, kind_of
+        self.duties = group.duties
+        self.quota = OrderedDict(quota)             # kind ==> # of candidates still to place
+        self.on = [set(s.parent for s in duty.students) for duty in self.duties]
+        self.new = [[] for duty in self.duties]     # candidates placed on each duty
+        self.placed = defaultdict(list)             # parent ==> [(candidate, duty #)]
+        # # of students a duty must have, and may have
+        self.need = [duty.n_filled() + group.need(duty) for duty in self.duties]
+        self.room = [duty.n_filled() + group.room(duty) for duty in self.duties]
+        self.scanned = self.conflicts = 0
+
+    def left(self): return sum(self.quota.values())
+
+    def _add(self, s, i):
+        _log.debug('+   %s  to %s (%s)', s, self.duties[i].date, self.duties[i].name)
+        self.duties[i].add(s)
+        self.on[i].add(s.parent)
+        self.new[i].append(s)
+        self.placed[s.parent].append( (s, i) )
+
+    def _remove(self, s, i):
+        _log.debug('-   %s  from %s (%s)', s, self.duties[i].date, self.duties[i].name)
+        self.duties[i].remove(s)
+        self.on[i].discard(s.parent)
+        self.new[i].remove(s)
+        self.placed[s.parent].remove( (s, i) )
+
+    def greedy(self, limit):
+        '''place candidates in selection order on the emptiest duty under limit without their parent'''
+        duties = self.duties
+        heap = [(duty.n_filled(), i) for i, duty in enumerate(duties) if duty.n_filled() < limit[i]]
+        heapq.heapify(heap)
+        for kind in self.quota:
+            pool, skipped = self.kinds[kind], []
+            while self.quota[kind] > 0 and pool and heap:
+                s = pool.pop()
+                self.scanned += 1
+                popped, i = [], None
+                while heap:
+                    item = heapq.heappop(heap)
+                    if s.parent not in self.on[item[1]]:
+                        i = item[1]
+                        break
+                    popped.append(item)
+                    self.conflicts += 1
+                for item in popped: heapq.heappush(heap, item)
+                if i is None:            # parent is on every duty with room, try another candidate
+                    skipped.append(s)
+                    continue
+                self._add(s, i)
+                self.quota[kind] -= 1
+                if duties[i].n_filled() < limit[i]: heapq.heappush(heap, (duties[i].n_filled(), i))
+            pool.extend(reversed(skipped))
+
+    def augment(self, limit):
+        '''place one more candidate along a shortest augmenting path, return False if there is none
+
+        Nodes are ('k', kind), ('f', parent) and ('d', duty #): a kind gives a candidate to its
+        families, a family sends a child to a duty it is not on or gives a candidate back to its
+        kind, a duty under limit takes the child, otherwise a family moves its child away.'''
+        if all(duty.n_filled() >= limit[i] for i, duty in enumerate(self.duties)): return False
+        prev = {}
+        queue = [('k', kind) for kind, n in self.quota.iteritems() if n > 0]
+        for node in queue: prev[node] = None
+        end = None
+        while queue and end is None:
+            nxt = []
+            for node in queue:
+                t, x = node
+                if t == 'k':
+                    out = [('f', s.parent) for s in self.kinds[x]]
+                elif t == 'f':
+                    out = [('d', i) for i in range(len(self.duties)) if x not in self.on[i]]
+                    out += [('k', self.kind_of[s]) for s, i in self.placed[x]]
+                elif self.duties[x].n_filled() < limit[x]:
+                    end = node
+                    break
+                else:
+                    out = [('f', s.parent) for s in self.new[x]]
+                for v in out:
+                    if v not in prev:
+                        prev[v] = node
+                        nxt.append(v)
+            queue = nxt
+        if end is None: return False
+
+        path = [end]
+        while prev[path[-1]] is not None: path.append(prev[path[-1]])
+        path.reverse()
+        self.quota[path[0][1]] -= 1
+        hand = None   # the candidate moving along the path
+        for (t, x), (u, y) in zip(path, path[1:]):
+            if t == 'k':                # an unused candidate of kind x from family y
+                pool = self.kinds[x]
+                hand = next(s for s in reversed(pool) if s.parent is y)
+                pool.remove(hand)
+            elif t == 'd':              # the candidate of family y leaves duty x
+                hand = next(s for s in self.new[x] if s.parent is y)
+                self._remove(hand, x)
+            elif u == 'd':
+                self._add(hand, y)
+                hand = None
+            else:                       # a candidate of kind y of family x is unused again, hand takes its spot
+                if self.kind_of[hand] != y:
+                    s, i = next((s, i) for s, i in self.placed[x] if self.kind_of[s] == y)
+                    self._remove(s, i)
+                    self._add(hand, i)
+                    hand = s
+                self.kinds[y].append(hand)
+                hand = None
+        return True
+
+    def place(self):
+        '''return # of candidates placed, the spots that must be filled first'''
+        total = self.left()
+        for limit in [self.need, self.room]:
+            self.greedy(limit)
+            while self.left() > 0 and self.augment(limit): pass
+        instrument.count('candidates_scanned', self.scanned)
+        instrument.count('parent_conflicts', self.conflicts)
+        return total - self.left()
+
+def fill_duties(asgm, after, seed=None):
+    '''fill open duty spots of arrangement asgm after a date, return False if there is no feasible assignment'''
+    with instrument.phase('pool_build'):
+        cands = asgm._collect_candidates(seed=seed)
+    asgm._bootstrap_duties(after)
+    groups = _groups(asgm)
+
+    # (family, group #) ==> # of duties of the group the family may take, if it has more candidates
+    taken = defaultdict(int)      # (parent, group #) ==> # of duties of the group the family is on
+    for i, group in enumerate(groups):
+        for duty in group.duties:
+            for p in set(s.parent for s in duty.students): taken[p, i] += 1
+    eligible, wanted = {}, defaultdict(int)
+    for c in cands:
+        s = c.student
+        eligible[s] = tuple(_eligible(g.duties[0], s) for g in groups)
+        for i, ok in enumerate(eligible[s]):
+            if ok: wanted[s.parent, i] += 1
+    tight = {}
+    for (p, i), n in wanted.iteritems():
+        free = len(groups[i].duties) - taken[p, i]
+        if n > free: tight[p, i] = free
+    tight_parents = set(p for p, i in tight)
+
+    # candidates of the same kind are interchangeable, kinds[kind] is in reverse selection order
+    kinds, kind_of = OrderedDict(), {}
+    for c in cands:
+        s = c.student
+        kind = (s.cls.ampm(), eligible[s], c.prio, s.parent if s.parent in tight_parents else None)
+        kinds.setdefault(kind, []).append(s)
+        kind_of[s] = kind
+    for pool in kinds.values(): pool.reverse()
+
+    unused, must_cost = _costs(set(kind[2] for kind in kinds))
+    g = _Graph()
+    src, sink = g.node(), g.node()
+    gnodes = [g.node() for group in groups]
+    fgnodes = {}   # (parent, group #) ==> node of a tight family
+    for key, free in tight.iteritems():
+        fgnodes[key] = g.node()
+        g.edge(fgnodes[key], gnodes[key[1]], free)
+    must, edges = [], {}
+    for kind, pool in kinds.iteritems():
+        k = g.node()
+        g.edge(src, k, len(pool))
+        g.edge(k, sink, len(pool), unused[kind[2]])
+        for i, ok in enumerate(kind[1]):
+            if ok: edges[kind, i] = g.edge(k, fgnodes.get((kind[3], i), gnodes[i]), len(pool))
+    for i, group in enumerate(groups):
+        need = sum(group.need(d) for d in group.duties)
+        room = sum(group.room(d) for d in group.duties)
+        must.append( (need, g.edge(gnodes[i], sink, need, must_cost)) )
+        g.edge(gnodes[i], sink, room-need)
+    with instrument.phase('flow_solve'):
+        g.min_cost_flow(src, sink)
+
+    _log.info('#candidates = %d', len(cands))
+    for i, group in enumerate(groups):
+        need, e = must[i]
+        if g.flow(e) < need:
+            _log.error('unable to fill %d %s duty spots, no enough students', need-g.flow(e), group)
+            return False
+
+    for i, group in enumerate(groups):
+        quota = OrderedDict((kind, g.flow(edges[kind, i])) for kind in kinds if (kind, i) in edges)
+        placed = _Placer(group, kinds, kind_of, quota).place()
+        if placed < sum(quota.values()):
+            _log.error('unable to fill %d %s duty spots without parent conflict', sum(quota.values())-placed, group)
+            return False
+        for duty in group.duties:
+            if group.need(duty) > 0:
+                _log.error('unable to fill %d spots of %s, no enough students', group.need(duty), repr(duty))
+                return False
+            duty.how_many = duty.n_filled()
+
+    left = defaultdict(int)   # prio ==> # of candidates left
+    for kind, pool in kinds.iteritems(): left[kind[2]] += len(pool)
+    if left[0] > 0:
+        _log.error('there are %d students not assigned, try to increase upper bound', left[0])
+        return False
+    for prio in sorted(left):
+        if prio > 0 and left[prio] > 0:
+            _log.warning('%d parents get %d duties instead of %d, no room for them', left[prio], prio, prio+1)
+    return True
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# registrations and POD arrangements of several school years in one indexed store
+#
+# A store is a directory with a segment file per school year, written once by add() from the
+# year's registration csv and constraint file, and an index of all segments: rows by student
+# ID, by family (the (mom, dad) key of Parent), by parent name and by date, and the # of active
+# students of each class.  Counts come from the index alone, rows are read from the segments
+# of the years they are in, so no csv or constraint file is parsed again after add().
+import getopt, sys, os, marshal, bisect
+from datetime import date
+from collections import namedtuple
+import ccl
+from ccl import *
+
+_STORE_VERSION = 1
+_ROW_BITS = 24   # a row of the index is segment # << _ROW_BITS | row # in the segment
+
+# a registration of a year, and a student on a duty of a year, the date is YYYY-MM-DD
+Enrollment = namedtuple('Enrollment', ['season', 'id', 'name', 'chinesename', 'cls', 'culture', 'status', 'active',
+                                       'pod', 'mom', 'dad'])
+DutyRecord = namedtuple('DutyRecord', ['season', 'date', 'duty', 'id', 'mom', 'dad'])
+
+def _extract():
+    '''return the enrollment rows of the loaded tables, without season'''
+    enrollments = []
+    for s in sorted(Student.all(), key=lambda s: s.id):
+        mom, dad = map(intern, s.parent.key) if s.parent is not None else ('', '')
+        enrollments.append( (s.id, s.name, s.chinesename or '', s.cls.name, s.culture.name if s.culture else None,
+                             s.status, s.isActive(), s.pod, mom, dad) )
+    return enrollments
+
+def _extract_duties(asgm):
+    '''return the duty rows of an arrangement, a row per student on a duty, without season'''
+    duties = []
+    for d in asgm.calendar.since(date.min):
+        for s in sorted(d.students, key=lambda s: s.id):
+            mom, dad = map(intern, s.parent.key) if s.parent is not None else ('', '')
+            duties.append( (intern(str(d.date)), intern(d.name), s.id, mom, dad) )
+    return duties
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return ccl.without_gc(marshal.load, f)
+
+def _write(path, data):
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump(data, f)
+    os.rename(tmp, path)
+
+class History(object):
+    '''store of the registrations and arrangements of school years in directory path'''
+    def __init__(self, path):
+        self.path = path
+        self._segments = {}   # season ==> (enrollment rows, duty rows), read on first use
+        self._load_index()
+
+    def _segment_file(self, season):
+        return os.path.join(self.path, season + '.segment')
+
+    def _index_file(self):
+        return os.path.join(self.path, 'index')
+
+    def _stored_seasons(self):
+        if not os.path.isdir(self.path): return []
+        return sorted(fn[:-len('.segment')] for fn in os.listdir(self.path) if fn.endswith('.segment'))
+
+    def _load_index(self):
+        '''read the index, rebuild it from the segments if it is missing or out of date'''
+        try:
+            index = _read(self._index_file())
+            if index[0] != _STORE_VERSION or sorted(index[1]) != self._stored_seasons(): index = None
+        except (IOError, EOFError, ValueError, TypeError):
+            index = None
+        if index is None:
+            self._new_index()
+            for season in self._stored_seasons(): self._index_segment(season, *self._segment(season))
+            if self.seasons: self._save_index()
+        else:
+            (version, self.seasons, self.students, self.families, self.family_duties, self.parents,
+             self.dates, self.date_rows, self.classes) = index
+
+    def _new_index(self):
+        self.seasons       = []                 # school years by segment #
+        self.students      = {}                 # student ID ==> [enrollment row]
+        self.families      = {}                 # (mom, dad) ==> [enrollment row]
+        self.family_duties = {}                 # (mom, dad) ==> [duty row]
+        self.parents       = {}                 # mom or dad name ==> [(mom, dad)]
+        self.dates         = []                 # sorted YYYY-MM-DD of all duty rows
+        self.date_rows     = []                 # duty row of each of dates
+        self.classes       = {}                 # season ==> {class name: # of active students}
+
+    def _index_segment(self, season, enrollments, duties):
+        base = len(self.seasons) << _ROW_BITS
+        self.seasons.append(season)
+        classes = self.classes[season] = {}
+        for i, (id, name, cname, cls, culture, status, active, pod, mom, dad) in enumerate(enrollments):
+            self.students.setdefault(id, []).append(base | i)
+            key = (mom, dad)
+            if key not in self.families:
+                self.families[key] = []
+                for n in key:
+                    if n: self.parents.setdefault(n, []).append(key)
+            self.families[key].append(base | i)
+            if active:
+                for c in [cls, culture]:
+                    if c is not None: classes[c] = classes.get(c, 0) + 1
+        dated = zip(self.dates, self.date_rows)
+        for i, (day, duty, id, mom, dad) in enumerate(duties):
+            self.family_duties.setdefault((mom, dad), []).append(base | i)
+            dated.append( (day, base | i) )
+        dated.sort()
+        self.dates = [day for day, row in dated]
+        self.date_rows = [row for day, row in dated]
+
+    def _save_index(self):
+        index = (_STORE_VERSION, self.seasons, self.students, self.families, self.family_duties, self.parents,
+                 self.dates, self.date_rows, self.classes)
+        _write(self._index_file(), index)
+
+    def _segment(self, season):
+        seg = self._segments.get(season)
+        if seg is None:
+            seg = self._segments[season] = _read(self._segment_file(season))
+        return seg
+
+    def add(self, season, csvfile, cstfile=None):
+        '''add the registrations of csvfile and the duties of cstfile as year season, return (# of registrations,
+        # of duty rows), raise ValueError if the store has the year already
+
+        The ccl tables are loaded from csvfile meanwhile, the tables loaded before are restored after.'''
+        if season in self.seasons: raise ValueError('%s is in %s already' % (season, self.path))
+        tables = [ccl._students, ccl._parents, ccl._classes, ccl._students_by_name, ccl._students_by_name_cls,
+                  ccl._parents_by_name, ccl._pod_children]
+        saved = [t.copy() for t in tables]
+        try:
+            ccl.reset()
+            for err in ccl.init(csvfile, skip_errors=True, needs=['culture']):
+                print >> sys.stderr, '%s: %s' % (csvfile, err)
+            enrollments, duties = _extract(), []
+            if cstfile:
+                asgm = Arrangement()
+                for diag in asgm.load(cstfile, strict=False):
+                    print >> sys.stderr, '%s: %s' % (cstfile, diag)
+                duties = _extract_duties(asgm)
+        finally:
+            for t, copy in zip(tables, saved):
+                t.clear()
+                t.update(copy)
+
+        if not os.path.isdir(self.path): os.makedirs(self.path)
+        _write(self._segment_file(season), (enrollments, duties))
+        self._segments[season] = (enrollments, duties)
+        self._index_segment(season, enrollments, duties)
+        self._save_index()
+        return len(enrollments), len(duties)
+
+    def _rows(self, refs, table, kind):
+        '''return the rows of an index, of table 0 (enrollments) or 1 (duties), as kind'''
+        mask = (1 << _ROW_BITS) - 1
+        rows = []
+        for ref in refs:
+            season = self.seasons[ref >> _ROW_BITS]
+            rows.append(kind(season, *self._segment(season)[table][ref & mask]))
+        return rows
+
+    def family_keys(self, name):
+        '''return the (mom, dad) keys of the families with a parent named name'''
+        return self.parents.get(ccl._proc_name(name), [])
+
+    def student(self, id):
+        '''return [Enrollment] of a student ID, year by year'''
+        return sorted(self._rows(self.students.get(id, []), 0, Enrollment))
+
+    def family(self, key):
+        '''return [Enrollment] of the children of a family, year by year'''
+        return sorted(self._rows(self.families.get(key, []), 0, Enrollment))
+
+    def count_family_duties(self, key, seasons=None):
+        '''return the # of duties taken by the children of a family, in seasons (default all)'''
+        rows = self.family_duties.get(key, [])
+        if seasons is None: return len(rows)
+        numbers = set(i for i, season in enumerate(self.seasons) if season in seasons)
+        return sum(1 for ref in rows if ref >> _ROW_BITS in numbers)
+
+    def duties_of_family(self, key):
+        '''return [DutyRecord] of the children of a family, year by year'''
+        return sorted(self._rows(self.family_duties.get(key, []), 1, DutyRecord))
+
+    def duties(self, first, last=None):
+        '''return [DutyRecord] between dates first and last (datetime.date, included), by date'''
+        lo = bisect.bisect_left(self.dates, str(first))
+        hi = len(self.dates) if last is None else bisect.bisect_right(self.dates, str(last))
+        return self._rows(self.date_rows[lo:hi], 1, DutyRecord)
+
+    def enrollment(self, season=None):
+        '''return {class name: # of active students} of a year, or {season: {class name: #}} of all years'''
+        if season is not None: return self.classes[season]
+        return dict(self.classes)
+
+def usage():
+    print \
+        '''%s --store <directory> [--add <school year, e.g. 2015-2016> --csv <registration csv> [--cst <pod arrangement>]]
+        [--student <ID>] [--family <mom or dad name>] [--duties <date>[,<date>]] [--enrollment <school year|all>]
+        --add,        add the registrations and duties of a school year to the store
+        --student,    registrations of a student ID in each year
+        --family,     children and # of POD duties of the families of a parent in each year
+        --duties,     duties on a date or between two dates
+        --enrollment, # of active students of each class''' % sys.argv[0]
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                ['store=', 'add=', 'csv=', 'cst=', 'student=', 'family=', 'duties=', 'enrollment=', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    store = season = csvfile = cstfile = None
+    queries = []
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--store':
+            store = v
+        elif o == '--add':
+            season = v
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--cst':
+            cstfile = v
+        else:
+            queries.append( (o[2:], v) )
+
+    if store is None:
+        print >> sys.stderr, 'Missing store directory'
+        usage()
+        sys.exit(1)
+    history = History(store)
+    if season:
+        if csvfile is None:
+            print >> sys.stderr, 'Missing student registration csv'
+            usage()
+            sys.exit(1)
+        try:
+            n, m = history.add(season, csvfile, cstfile)
+        except ValueError as err:
+            print >> sys.stderr, err
+            sys.exit(1)
+        print '%s: %d registrations, %d duty rows' % (season, n, m)
+
+    for q, v in queries:
+        if q == 'student':
+            for e in history.student(int(v)):
+                print '%s  %-24s %-6s %-12s %s' % (e.season, e.name, e.cls, e.culture or '', e.status)
+        elif q == 'family':
+            for key in history.family_keys(v):
+                print '--- %s, %s: %d duties ---' % (key[0], key[1], history.count_family_duties(key))
+                for season in sorted(history.seasons):
+                    children = ', '.join('%s (%s)' % (e.name, e.cls) for e in history.family(key) if e.season == season)
+                    duties = history.count_family_duties(key, [season])
+                    if children or duties: print '%s  %d duties  %s' % (season, duties, children)
+        elif q == 'duties':
+            try:
+                dates = [date(*map(int, d.split('-'))) for d in v.split(',')]
+            except (ValueError, TypeError):
+                print >> sys.stderr, 'Bad date in --duties %s, expect YYYY-MM-DD[,YYYY-MM-DD]' % v
+                sys.exit(1)
+            for d in history.duties(dates[0], dates[-1]):
+                print '%s %-4s %s, %s' % (d.date, d.duty, d.id, ' and '.join(n for n in [d.mom, d.dad] if n))
+        elif q == 'enrollment':
+            seasons = sorted(history.seasons) if v == 'all' else [v]
+            for season in seasons:
+                classes = history.classes.get(season, {})
+                print '--- %s: %d ---' % (season, sum(classes.values()))
+                for cls in sorted(classes): print '%-12s %5d' % (cls, classes[cls])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# phase timers and counters of the CCL tools, off unless enable() is called
+#
+# The tools log through the standard logging module under the "ccl" logger, which has no
+# output until a handler is configured (see podutil.py --log).  Timers and counters are kept
+# here so that a run can be exported as JSON (podutil.py --stats).  When disabled, phase()
+# returns a shared no-op context manager and count() returns at once, callers count in local
+# variables inside loops and report once.
+import time, json
+from collections import OrderedDict
+
+enabled  = False
+timers   = OrderedDict()   # phase ==> [seconds, # of runs]
+counters = OrderedDict()   # name ==> count
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+class _Phase(object):
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, *exc):
+        t = timers.get(self.name)
+        if t is None: t = timers[self.name] = [0.0, 0]
+        t[0] += time.time() - self.t0
+        t[1] += 1
+
+class _NoPhase(object):
+    def __enter__(self): pass
+    def __exit__(self, *exc): pass
+
+_no_phase = _NoPhase()
+
+def phase(name):
+    '''with phase(name): ... adds the elapsed time to timers[name]'''
+    if not enabled: return _no_phase
+    return _Phase(name)
+
+def count(name, n=1):
+    if enabled: counters[name] = counters.get(name, 0) + n
+
+def report():
+    '''return {"timers": {phase: {"seconds", "runs"}}, "counters": {name: count}}'''
+    return OrderedDict([
+        ('timers', OrderedDict((name, OrderedDict([('seconds', round(t[0], 6)), ('runs', t[1])]))
+                               for name, t in timers.iteritems())),
+        ('counters', OrderedDict(counters))])
+
+def dump(fh):
+    json.dump(report(), fh, indent=2)
+    fh.write('\n')
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# place students into culture classes from the ranked choices of the registration
+#
+# Every culture class has a capacity and may be given for the AM or the PM students only
+# (the session of a student is Class.ampm() of the language class).  Families are served in
+# registration order (the lowest ID of their children): each child gets the best ranked class
+# with a seat left, which is the stable assignment when all classes rank the families the same
+# way.  Siblings who list a class at the same rank get it together or not at all, if it has
+# no seats for all of them they go on to their next choices.  A student already registered in
+# a culture class keeps it, and takes one of its seats, unless the placement is redone.
+import getopt, sys, csv
+from collections import OrderedDict, namedtuple, defaultdict
+import ccl
+from ccl import *
+
+_choice_fields = ['culture_choice_1', 'culture_choice_2', 'culture_choice_3']
+
+# capacity and session (AM, PM, or NOON for all students) of a culture class
+Capacity = namedtuple('Capacity', ['seats', 'session'])
+
+def read_choices(csvfile):
+    '''return {student ID: [culture class names by rank]} of the registration csv, names in lower case'''
+    choices = {}
+    for rec in iter_registration(csvfile, set(['id'] + _choice_fields)):
+        names = []
+        for name in (rec.culture_choice_1, rec.culture_choice_2, rec.culture_choice_3):
+            name = name.lower()   # culture class name is case insensitive
+            if name and name not in names: names.append(name)
+        if names:
+            try:
+                choices[int(rec.id)] = names
+            except ValueError:
+                pass              # a bad ID is reported by ccl.init()
+    return choices
+
+def read_capacities(filename):
+    '''return OrderedDict {culture class name: Capacity} of a csv of "class, seats[, AM|PM]" rows'''
+    capacities = OrderedDict()
+    with open(filename, 'rb') as f:
+        for lineno, row in enumerate(csv.reader(f), 1):
+            row = [x.strip() for x in row]
+            if not row or not row[0] or row[0].startswith('#'): continue
+            try:
+                seats = int(row[1])
+            except (IndexError, ValueError):
+                if lineno == 1: continue    # header
+                raise ValueError('%s line %d: bad # of seats' % (filename, lineno))
+            session = row[2].upper() if len(row) > 2 and row[2] else 'NOON'
+            if session not in ['AM', 'PM', 'NOON']:
+                raise ValueError('%s line %d: unknown session %s' % (filename, lineno, row[2]))
+            capacities[row[0].lower()] = Capacity(seats, session)
+    return capacities
+
+def place(choices, capacities, replace=False):
+    '''place the active students of choices {ID: [class names]} into culture classes of capacities
+
+    Return (placed [(student, class name, rank)], unplaced [student]), the culture registration
+    of the loaded students is changed accordingly.  replace=True places again the students
+    registered in a culture class, otherwise they keep their class.  A registered student without
+    choices keeps the class, and its seat, either way.'''
+    seats = dict((name, c.seats) for name, c in capacities.iteritems())
+    families = defaultdict(list)   # parent ==> children to place
+    for id, names in choices.iteritems():
+        s = ccl._students.get(id)
+        if s is None or not s.isActive(): continue
+        if s.culture is not None and not replace: continue
+        families[s.parent].append(s)
+    for s in Student.all():   # registrations kept take their seats
+        if s.culture is None or not s.isActive() or s.culture.name not in seats: continue
+        if not replace or s.id not in choices: seats[s.culture.name] -= 1
+
+    def eligible(s):
+        '''return [(rank, class name)] of the choices of s given for the session of s'''
+        r = []
+        for rank, name in enumerate(choices[s.id], 1):
+            c = capacities.get(name)
+            if c is not None and (c.session == 'NOON' or c.session == s.cls.ampm()): r.append( (rank, name) )
+        return r
+
+    placed, unplaced = [], []
+    for children in sorted(families.itervalues(), key=lambda ss: min(s.id for s in ss)):
+        left = [(s, eligible(s)) for s in sorted(children, key=lambda s: s.id)]
+        for i in range(len(_choice_fields)):
+            wanted = OrderedDict()   # class name ==> siblings asking for it as their i-th choice
+            for s, names in left:
+                if i < len(names): wanted.setdefault(names[i][1], []).append( (s, names[i][0]) )
+            got = set()
+            for name, ss in wanted.iteritems():
+                if seats[name] < len(ss): continue
+                seats[name] -= len(ss)
+                for s, rank in ss:
+                    placed.append( (s, name, rank) )
+                    got.add(s)
+            left = [(s, names) for s, names in left if s not in got]
+        unplaced += [s for s, names in left]
+
+    for s, name, rank in placed:
+        s.register_culture(ccl._classes.get(name) or Class.add(Class(name)))
+    if replace:
+        for s in unplaced: s.register_culture(None)
+    return placed, unplaced
+
+def write_placement(fh, placed, unplaced):
+    '''write a csv of the students placed, by class, then of the students not placed'''
+    writer = csv.writer(fh, lineterminator='\n')
+    writer.writerow(['ID', 'Student', 'Class', 'Culture Class', 'Choice'])
+    for s, name, rank in sorted(placed, key=lambda p: (p[1], p[0].name)):
+        writer.writerow([s.id, s.name, s.cls.name, name, rank])
+    for s in sorted(unplaced, key=lambda s: s.id):
+        writer.writerow([s.id, s.name, s.cls.name, '', ''])
+
+def usage():
+    print \
+        '''%s --csv <registration csv> --capacity <csv of class, seats[, AM|PM]> [--output <csv>] [--replace] [--no-cache]
+        place the students into the culture classes of their Culture choice #1..#3 columns
+        --capacity, seats of each culture class, AM or PM for a class of the AM or PM students only
+        --output,   write the placement to this csv file, default stdout
+        --replace,  also place again the students registered in a culture class''' % sys.argv[0]
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['csv=', 'capacity=', 'output=', 'replace', 'no-cache', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile = capfile = output = None
+    replace, cache = False, True
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--capacity':
+            capfile = v
+        elif o == '--output':
+            output = v
+        elif o == '--replace':
+            replace = True
+        elif o == '--no-cache':
+            cache = False
+
+    if csvfile is None or capfile is None:
+        print >> sys.stderr, 'Missing %s' % ('student registration csv' if csvfile is None else 'capacity file')
+        usage()
+        sys.exit(1)
+
+    try:
+        capacities = read_capacities(capfile)
+    except ValueError as err:
+        print >> sys.stderr, err
+        sys.exit(1)
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=['culture']):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    placed, unplaced = place(read_choices(csvfile), capacities, replace)
+
+    if output:
+        with open(output, 'wb') as f:
+            write_placement(f, placed, unplaced)
+    else:
+        write_placement(sys.stdout, placed, unplaced)
+    taken = defaultdict(int)
+    for s in Student.all():
+        if s.culture is not None and s.isActive(): taken[s.culture.name] += 1
+    for name, c in capacities.iteritems():
+        print >> sys.stderr, '%-16s %4d/%-4d %s' % (name, taken[name], c.seats, c.session)
+    print >> sys.stderr, '%d placed, %d not placed' % (len(placed), len(unplaced))
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,39 @@
 #!/usr/bin/python
-import getopt, sys, os
+import getopt, sys, os, logging, tempfile, shutil
 from datetime import date, datetime
-from collections import defaultdict
-import ccl
+from collections import OrderedDict, defaultdict
+import ccl, instrument
 from ccl import *
 
+_log = logging.getLogger('ccl.podutil')
 
 def usage():
     print \
-        '''%s --csv <registration csv> [--after <date, e.g. 2015-09-20>] [--fill <output>] [--post <file>] [--summary <file>] [--sign <signup pdf>] <pod arrangement>
+        '''%s --csv <registration csv> [--after <date, e.g. 2015-09-20>] [--fill <output>] [--seed <n>] [--trials <n>] [--workers <n>] [--last <roster snapshot>] [--post <file>] [--summary <file>] [--sign <signup pdf>] [--dedupe] [--no-cache] [--log <level>] [--stats <json file>] <pod arrangement>
         --csv,   the csv file download from student registration sheet
-        --fill,  fill the open duty, write to output file
+        --no-cache, always parse the csv file instead of loading its cached snapshot
+        --fill,  fill the open duty, write to output file, in JSON lines (students by ID) if it ends with .json
+        --seed,  random seed of the fill, the seed of each fill is printed on stderr to reproduce it
+        --trials, fill with this many seeds and keep the best scored arrangement, default 1
+        --workers, # of processes running the trials and rendering the --sign dates, default 1
+        --last,  roster snapshot of the last --fill, only re-fill the spots of students changed since then;
+                 written after each --fill, --seed applies to the re-fill, --trials can not be used
         --after, fill open duties and display duty summary after this date, default is today()
         --post,  write to this file the POD information sorted by student's lastname
         --summary, write to this file the POD summary sorted by date
-        --sign, write to a pdf file for POD signatures''' % sys.argv[0]
+        --sign, write to a pdf file for POD signatures, or to one pdf per date if it is a directory;
+                 a file is rendered in --workers processes only if PyPDF2 (optional) is installed
+        --dedupe, merge the families registered twice under name or contact variants before the fill,
+                 candidates not merged are logged as warnings (see dedupe.py)
+        --log,   debug|info|warning|error, messages shown on stderr, default warning; debug lists every assigned student
+        --stats, write phase timings and fill counters to this JSON file, '-' for stdout;
+                 the fills of --trials in --workers processes are not counted
+        <pod arrangement> is a .cst text file or a JSON lines file written by --fill''' % sys.argv[0]
         
 def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'hf:a:p:s:x', 
-                ['csv=', 'help', 'fill=', 'after=', 'post=', 'summary=', 'sign='])
+                ['csv=', 'help', 'fill=', 'after=', 'seed=', 'trials=', 'workers=', 'last=', 'post=', 'summary=', 'sign=', 'dedupe', 'no-cache', 'log=', 'stats='])
     except getopt.GetoptError as err:
         print str(err)
         usage()
@@ -28,7 +42,10 @@ def main():
     csvfile = None
     output = None
     after = date.today()
-    post  = summary = sign = None
+    post  = summary = sign = last = None
+    cache, dedupe = True, False
+    level, stats = logging.WARNING, None
+    seed, trials, workers = None, 1, 1
 
     for o, v in opts:
         if o in ('-h', '--help'):
@@ -41,12 +58,32 @@ def main():
         elif o in ('-a', '--after'):
             y, m, d = v.split('-')
             after = date(int(y), int(m), int(d))
+        elif o == '--no-cache':
+            cache = False
+        elif o == '--dedupe':
+            dedupe = True
+        elif o == '--seed':
+            seed = int(v)
+        elif o == '--trials':
+            trials = int(v)
+        elif o == '--workers':
+            workers = int(v)
+        elif o == '--last':
+            last = v
         elif o in ('-p', '--post'):
             post = v
         elif o in ('-s', '--summary'):
             summary = v
         elif o in ('-x', '--sign'):
             sign = v
+        elif o == '--log':
+            level = getattr(logging, v.upper(), None)
+            if not isinstance(level, int):
+                print >> sys.stderr, 'Unknown log level %s' % v
+                usage()
+                sys.exit(1)
+        elif o == '--stats':
+            stats = v
             
     if csvfile is None :
         print >> sys.stderr, 'Missing student registration csv'
@@ -59,17 +96,36 @@ def main():
         sys.exit(1)
 
     cstfile = args[0]
+    if last and trials > 1:
+        print >> sys.stderr, '--trials can not be used with --last'
+        usage()
+        sys.exit(1)
 
-    ccl.init(csvfile)
+    logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
+    if stats: instrument.enable()
+
+    # a constraint file may name a student by the culture class, only the summary lists contacts
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=['culture', 'contacts'] if summary or dedupe else ['culture']):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    if dedupe: _dedupe()
     asgm = Arrangement()
-    asgm.load(cstfile)
+    for diag in asgm.load(cstfile):
+        print >> sys.stderr, '%s: %s' % (cstfile, diag)
 
     if output is not None:
-        if not asgm.fill_duties(after):
+        if last and os.path.exists(last):
+            ok = asgm.repair_duties(ccl.changed_students(ccl.load_roster_snapshot(last)), after, seed)
+        else:
+            ok = asgm.fill_duties(after, seed=seed, trials=trials, workers=workers)
+        if not ok:
             print >> sys.stderr, 'There is something wrong in filling duty spot, please adjust parameter and retry'
             sys.exit(1)
-        with open(output, 'wt') as f:
-            print >> f, str(asgm)
+        if trials > 1:
+            print >> sys.stderr, 'seed = %d, score = %.3f (best of %d trials)' % (asgm.seed, asgm.best_score, trials)
+        else:
+            print >> sys.stderr, 'seed = %d' % asgm.seed
+        asgm.save(output)
+        if last: ccl.save_roster_snapshot(last)
 #        print asgm
 
     if post:
@@ -81,7 +137,13 @@ def main():
             write_summary(f, asgm, after)
    
     if sign:
-        write_pdf_pod_signature(sign, asgm, after)
+        write_pdf_pod_signature(sign, asgm, after, workers)
+
+    if stats == '-':
+        instrument.dump(sys.stdout)
+    elif stats:
+        with open(stats, 'wt') as f:
+            instrument.dump(f)
             
 def write_post(fh, asgm):
     ps = defaultdict(list)
@@ -100,13 +162,8 @@ def write_post(fh, asgm):
 
         
 def write_summary(fh, asgm, after):
-    all = defaultdict(list)
-    for duty in asgm.duties:
-        if duty.date <= after: continue
-        all[duty.date].append(duty)
- 
-    for dt in sorted(all):
-        ds = all[dt]
+    for dt in asgm.calendar.dates_after(after):
+        ds = asgm.calendar.on(dt)
         print >> fh, '----- %s ------' % dt.strftime('%B %d, %Y')
         for d in ds:
             leading = '[%s]'%d.name
@@ -114,50 +171,125 @@ def write_summary(fh, asgm, after):
                 print >> fh, '[%s] %-25s %-25s %s' % (d.name, s, s.parent.phones_str, s.parent.emails_str)
             print >> fh
 
-def write_pdf_pod_signature(pdff, asgm, after):
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, TableStyle
+def _dedupe():
+    '''merge the duplicated families of the loaded tables'''
+    import dedupe
+    candidates = dedupe.find_duplicates()
+    for c in candidates:
+        if c.action == 'flag': _log.warning('%r, %r: %s', c.a, c.b, c.reason)
+    merged = dedupe.merge_duplicates(candidates)
+    if merged:
+        _log.warning('%d families merged into %d', sum(len(others) for keep, others in merged), len(merged))
+
+_sign_template = {}   # reportlab objects shared by the sign in sheets rendered in a process
+
+def _sign_sheet_template():
+    '''return the styles of the sign in sheets, built once per process'''
+    if not _sign_template:
+        from reportlab.platypus import Paragraph, TableStyle
+        from reportlab.lib import colors
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.lib.units import inch, pica
+        styles = getSampleStyleSheet()
+        _sign_template.update(
+            date_style = styles["Heading2"],
+            title = Paragraph('SBCCL Parent-on-Duty Sign In/Out Sheet', styles["Heading1"]),
+            table_style = TableStyle([('SPAN',(2,0),(3,0)),
+                                      ('GRID', (0,0), (-1,-1), 0.25, colors.black),
+                                      ('LINEBELOW',(0,0),(-1,0),1,colors.black),
+                                      ('BOX', (0,0), (-1,-1), 0.5, colors.black),
+                                      ('FONT', (0,0), (-1,-1), 'Helvetica-Bold',16),
+                                      ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+                                     ]),
+            row_height = 2.9*pica,
+            title_space = 0.4*inch,
+            duty_space = 0.8*inch,
+            bottom_margin = 0.5*inch)
+    return _sign_template
+
+def _sign_sheet_elements(dt, duties):
+    '''return the flowables of the sign in sheet of a date, duties = [(duty name, [student name])]'''
+    from reportlab.platypus import Paragraph, Spacer, Table
+    tmpl = _sign_sheet_template()
+    elements = [Paragraph(dt.strftime('%B %d, %Y'), tmpl['date_style']), tmpl['title'], Spacer(1, tmpl['title_space'])]
+    for name, students in duties:
+        data = [(name, 'Board Member  ', ' '*40, '')] + [(name, s, '', '') for s in students]
+        t = Table(data, rowHeights=(tmpl['row_height'],)*len(data), hAlign='LEFT')
+        t.setStyle(tmpl['table_style'])
+        elements += [t, Spacer(1, tmpl['duty_space'])]
+    return elements
+
+def _sign_doc(pdff):
+    from reportlab.platypus import SimpleDocTemplate
     from reportlab.lib.pagesizes import letter
-    from reportlab.lib import colors
-    from reportlab.lib.styles import getSampleStyleSheet
-    from reportlab.lib.units import inch, pica
+    return SimpleDocTemplate(pdff, pagesize=letter, bottomMargin=_sign_sheet_template()['bottom_margin'])
+
+def _write_sign_sheet(args):
+    '''render the sign in sheet of one date to its own pdf, args = (pdf, date, duties), return pdf'''
+    pdff, dt, duties = args
+    _sign_doc(pdff).build(_sign_sheet_elements(dt, duties))
+    return pdff
+
+def _render(jobs, workers):
+    '''run _write_sign_sheet on jobs in workers processes, return the pdfs'''
+    if workers <= 1 or len(jobs) <= 1: return map(_write_sign_sheet, jobs)
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(_write_sign_sheet, jobs, chunksize=1)
+    finally:
+        pool.terminate()
+
+class _SignStory(list):
+    '''flowables of the sign in sheets of [(date, duties)], the sheet of the next date is added when the
+    doc template has laid out all the flowables before it, so one date of flowables is kept at a time'''
+    def __init__(self, dates):
+        list.__init__(self)
+        self._dates = iter(dates)
+
+    def __len__(self):   # checked by the doc template before it takes each flowable
+        if not list.__len__(self):
+            for dt, duties in self._dates:
+                from reportlab.platypus import PageBreak
+                self.extend(_sign_sheet_elements(dt, duties) + [PageBreak()])
+                break
+        return list.__len__(self)
+
+def write_pdf_pod_signature(pdff, asgm, after, workers=1):
+    '''write the sign in sheets of the duties after a date, a page per date
+
+    pdff is a pdf file, or a directory to get one pod-<date>.pdf per date rendered in workers
+    processes.  The pdf file is built here a date at a time, except with workers > 1 and PyPDF2
+    (optional): then every date is rendered in the workers to a pdf of its own, and the dates are
+    merged into the pdf file, which keeps all the pages in memory until it is written.'''
+    dates = OrderedDict((dt, [(duty.name, [str(s) for s in duty.students]) for duty in asgm.calendar.on(dt)])
+                        for dt in asgm.calendar.dates_after(after))
+
+    if os.path.isdir(pdff):
+        _render([(os.path.join(pdff, 'pod-%s.pdf' % dt), dt, dates[dt]) for dt in dates], workers)
+        return
+
+    PdfFileMerger = None
+    if workers > 1:
+        try:
+            from PyPDF2 import PdfFileMerger
+        except ImportError:
+            pass
+    if PdfFileMerger is None:
+        _sign_doc(pdff).build(_SignStory(dates.iteritems()))
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        parts = _render([(os.path.join(tmpdir, '%s.pdf' % dt), dt, dates[dt]) for dt in dates], workers)
+        merger = PdfFileMerger()
+        for part in parts: merger.append(part)   # read from the part file, not copied into memory
+        with open(pdff, 'wb') as f:
+            merger.write(f)
+        merger.close()
+    finally:
+        shutil.rmtree(tmpdir)
 
-    styles = getSampleStyleSheet()
-    
-    doc = SimpleDocTemplate(pdff, pagesize=letter, bottomMargin=0.5*inch)
-    elements = []
-    
-    ts = TableStyle([('SPAN',(2,0),(3,0)),
-                        ('GRID', (0,0), (-1,-1), 0.25, colors.black),
-                        ('LINEBELOW',(0,0),(-1,0),1,colors.black),
-                        ('BOX', (0,0), (-1,-1), 0.5, colors.black),
-                        ('FONT', (0,0), (-1,-1), 'Helvetica-Bold',16),
-                        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-                    ])
-    
-    all = defaultdict(list)
-    for duty in asgm.duties:
-        if duty.date <= after: continue
-        all[duty.date].append(duty)
- 
-    for dt in sorted(all):
-        elements.append(Paragraph(dt.strftime('%B %d, %Y'), styles["Heading2"]))
-        elements.append(Paragraph('SBCCL Parent-on-Duty Sign In/Out Sheet', styles["Heading1"]))
-        elements.append(Spacer(1,0.4*inch))
-        ds = all[dt]
-        for d in ds:
-            leading = '[%s]'%d.name
-            data= [(d.name, 'Board Member  ', ' '*40, '') ]
-            
-            for s in d.students:
-                data.append((d.name, s, '', ''))
-            t=Table(data, rowHeights=(2.9*pica,)*len(data), hAlign='LEFT')
-            t.setStyle(ts)
-            elements.append(t)
-            elements.append(Spacer(1, 0.8*inch))
-        elements.append(PageBreak())
-        
-    doc.build(elements)
-    
 if __name__ == "__main__":
     main()
     
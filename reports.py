@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# the reports of classinfo.py, checkinfo.py and podutil.py from a single load of the registration
+import getopt, sys, codecs, logging
+from datetime import date
+import ccl
+from ccl import *
+import classinfo, checkinfo, podutil
+
+def usage():
+    print \
+        '''%s --csv <registration csv> [--no-cache] [--after <date, e.g. 2015-09-20>] [--workers <n>]
+        [--roster <file>] [--roster-class <classes>] [--tuition <file>] [--tuition-class <classes>]
+        [--post <file>] [--summary <file>] [--sign <signup pdf>] [<pod arrangement>]
+        --roster,  write contact info class by class (classinfo.py), of --roster-class, default language
+        --tuition, write tuition checks by amount (checkinfo.py), of --tuition-class, default language
+                   classes are language, culture or comma separated class names, e.g. B1P,Dance
+        --post, --summary, --sign, the POD reports of podutil.py, need <pod arrangement>
+        --after,   date of the POD reports, default is today()
+        --workers, # of processes writing the reports at the same time, default 1''' % sys.argv[0]
+
+# reports to write, set by main() before the workers fork: [(name, function, args)]
+_jobs = []
+
+def _write(i):
+    '''write report _jobs[i], return an error message or None'''
+    name, fn, args = _jobs[i]
+    try:
+        fn(*args)
+    except Exception as err:
+        return '%s: %s' % (name, err)
+
+def _write_file(fn, report, *args):
+    '''call report(fh, *args) on file fn, the roster has unicode names'''
+    if report is classinfo.write_roster:
+        fh = codecs.open(fn, 'w', 'utf8')
+    else:
+        fh = open(fn, 'wt')
+    with fh:
+        report(fh, *args)
+
+def _classes(classname):
+    try:
+        return classinfo.select_classes(classname)
+    except KeyError as err:
+        print >> sys.stderr, 'Unknow classname %s' % err.args[0]
+        sys.exit(1)
+
+def write_all(jobs, workers=1):
+    '''write the reports [(name, function, args)], in workers processes forked after the load, return error messages'''
+    global _jobs
+    _jobs = jobs
+    try:
+        if workers > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            try:
+                errors = pool.map(_write, range(len(jobs)), chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            errors = map(_write, range(len(jobs)))
+    finally:
+        _jobs = []
+    return [e for e in errors if e]
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                ['csv=', 'no-cache', 'after=', 'workers=', 'roster=', 'roster-class=', 'tuition=', 'tuition-class=',
+                 'post=', 'summary=', 'sign=', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile = roster = tuition = post = summary = sign = None
+    roster_class = tuition_class = 'language'
+    cache, after, workers = True, date.today(), 1
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--no-cache':
+            cache = False
+        elif o == '--after':
+            y, m, d = v.split('-')
+            after = date(int(y), int(m), int(d))
+        elif o == '--workers':
+            workers = int(v)
+        elif o == '--roster':
+            roster = v
+        elif o == '--roster-class':
+            roster_class = v
+        elif o == '--tuition':
+            tuition = v
+        elif o == '--tuition-class':
+            tuition_class = v
+        elif o == '--post':
+            post = v
+        elif o == '--summary':
+            summary = v
+        elif o == '--sign':
+            sign = v
+
+    if csvfile is None:
+        print >> sys.stderr, 'Missing student registration csv'
+        usage()
+        sys.exit(1)
+    if (post or summary or sign) and not args:
+        print >> sys.stderr, 'Missing constraint file'
+        usage()
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    needs = set(['culture'])
+    if roster: needs.add('contacts')
+    if tuition: needs.add('checks')
+    if summary: needs.add('contacts')
+    for err in ccl.init(csvfile, skip_errors=True, cache=cache, needs=needs):   # a bad row is skipped, not the whole load
+        print >> sys.stderr, '%s: %s' % (csvfile, err)
+    jobs = []
+    if roster:  jobs.append( (roster, _write_file, (roster, classinfo.write_roster, _classes(roster_class))) )
+    if tuition: jobs.append( (tuition, _write_file, (tuition, checkinfo.write_tuition, _classes(tuition_class), tuition_class)) )
+
+    if args:
+        cstfile = args[0]
+        asgm = Arrangement()
+        for diag in asgm.load(cstfile):
+            print >> sys.stderr, '%s: %s' % (cstfile, diag)
+        if post:    jobs.append( (post, _write_file, (post, podutil.write_post, asgm)) )
+        if summary: jobs.append( (summary, _write_file, (summary, podutil.write_summary, asgm, after)) )
+        # the sign sheets have workers of their own only when the workers of write_all() are not used
+        if sign:    jobs.append( (sign, podutil.write_pdf_pod_signature, (sign, asgm, after, 1 if jobs else workers)) )
+
+    if not jobs:
+        print >> sys.stderr, 'No report to write'
+        usage()
+        sys.exit(1)
+    errors = write_all(jobs, workers)
+    for err in errors: print >> sys.stderr, err
+    if errors: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
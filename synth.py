@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# synthetic school data for benchmarks: registration csv and constraint files
+import getopt, sys, csv, random
+from datetime import date, timedelta
+from collections import OrderedDict
+import ccl
+from ccl import Student
+
+_first_names = ['Josh', 'Amy', 'Kevin', 'Lily', 'Eric', 'Grace', 'Ryan', 'Emma', 'Jason', 'Chloe',
+                'Daniel', 'Sophia', 'Andrew', 'Olivia', 'Brian', 'Irene', 'Henry', 'Angela', 'Victor', 'Cindy']
+_last_names  = ['Huang', 'Wang', 'Li', 'Zhang', 'Liu', 'Chen', 'Yang', 'Zhao', 'Wu', 'Zhou',
+                'Xu', 'Sun', 'Ma', 'Zhu', 'Hu', 'Guo', 'He', 'Lin', 'Luo', 'Gao']
+_culture_classes = ['Dance', 'Chess', 'Art', 'Wushu', 'Calligraphy', 'Go', 'Music']
+
+_syllables = ['an', 'bo', 'chen', 'da', 'fei', 'gang', 'hai', 'hui', 'jia', 'jun', 'kai', 'lan', 'lei', 'ling',
+              'ming', 'na', 'ning', 'pei', 'qi', 'qing', 'rui', 'shan', 'tao', 'ting', 'wei', 'wen', 'xin', 'xue',
+              'yan', 'yi', 'ying', 'yu', 'yun', 'ze', 'zhi', 'zi']
+
+def _unique_first_name(n):
+    '''return a distinct given name for every n, so student names never collide'''
+    parts = []
+    while True:
+        n, r = divmod(n, len(_syllables))
+        parts.append(_syllables[r])
+        if n == 0: break
+    return ''.join(parts).capitalize()
+
+# class names of each kind of class, a session suffix is added to K/B/C names
+_class_kinds = OrderedDict([
+    ('K',  ['K']),
+    ('B',  ['B%d' % g for g in range(1, 10)]),
+    ('C',  ['C%d' % g for g in range(1, 6)]),
+    ('AP', ['Pre-AP', 'AP']),
+    ('AA', ['AA']),
+])
+
+class School:
+    '''parameters of a synthetic school
+
+    families:   # of families
+    children:   the # of children of a family is drawn from this list
+    mix:        {kind: weight} of the class kinds K/B/C/AP/AA, AA registrations are adult students
+    am_rate:    share of K/B/C registrations in AM classes
+    withdraw_rate, pending_rate:  share of Withdrawn and Pending registrations, the others are Active
+    check_pending_rate:  share of Pending tuition/POD checks of the Active registrations
+    exempt_rate, culture_rate, donation_rate:  share of POD exempted, culture class and donating registrations'''
+    def __init__(self, families=11000, seed=0, children=(1, 1, 2, 2, 3), mix=None, am_rate=0.5,
+                 withdraw_rate=0.1, pending_rate=0.1, check_pending_rate=0.0, exempt_rate=0.09,
+                 culture_rate=0.4, donation_rate=0.0):
+        self.families, self.seed, self.children = families, seed, children
+        self.mix = OrderedDict([('K', 2), ('B', 18), ('C', 10), ('AP', 2), ('AA', 1)]) if mix is None else mix
+        self.am_rate = am_rate
+        self.withdraw_rate, self.pending_rate, self.check_pending_rate = withdraw_rate, pending_rate, check_pending_rate
+        self.exempt_rate, self.culture_rate, self.donation_rate = exempt_rate, culture_rate, donation_rate
+
+    def _class(self, rnd):
+        '''return a random class name and whether it is an adult class'''
+        total = float(sum(self.mix.values()))
+        x, kind = rnd.random()*total, None
+        for kind, weight in self.mix.iteritems():
+            x -= weight
+            if x < 0: break
+        name = rnd.choice(_class_kinds[kind])
+        if kind in ['K', 'B', 'C']: name += 'A' if rnd.random() < self.am_rate else 'P'
+        return name, kind == 'AA'
+
+    def write_registration(self, fh):
+        '''write the registration csv, return # of rows'''
+        rnd = random.Random(self.seed)
+        writer = csv.writer(fh)
+        writer.writerow(ccl._registration_columns.values())
+        sid = 0
+        for f in xrange(self.families):
+            last = rnd.choice(_last_names)
+            dad  = '%s %s' % (rnd.choice(_first_names), last)
+            mom  = '%s %s' % (rnd.choice(_first_names), rnd.choice(_last_names))
+            phone = '%03d-%03d-%04d' % (rnd.randint(200, 999), rnd.randint(200, 999), rnd.randint(0, 9999))
+            email = '%s%d@example.com' % (last.lower(), f)
+            for c in xrange(rnd.choice(self.children)):
+                sid += 1
+                x = rnd.random()
+                if x < self.withdraw_rate:
+                    status, check_status = 'Withdrawn', 'Returned'
+                elif x < self.withdraw_rate + self.pending_rate:
+                    status, check_status = 'Pending', 'Pending'
+                else:
+                    status = 'Active'
+                    check_status = 'Pending' if rnd.random() < self.check_pending_rate else 'Received'
+                cls, adult = self._class(rnd)
+                pod = rnd.choice(['Exempt', 'Teacher']) if rnd.random() < self.exempt_rate else ''
+                if adult: pod = 'Adult Student'
+                row = OrderedDict((k, '') for k in ccl._registration_columns)
+                row.update(id=sid, school_year='2015-2016', cls=cls, student='%s %s' % (_unique_first_name(sid), last),
+                           pod=pod, family=dad, family_mother=mom, home_phone_1=phone, email_1=email, status=status,
+                           tuition_check_amount=rnd.choice([350, 400, 450]), tuition_check_num=1000+sid,
+                           tuition_check_status=check_status, onduty_check_num=2000+sid,
+                           onduty_check_status=check_status)
+                if rnd.random() < self.culture_rate:
+                    choices = rnd.sample(_culture_classes, 3)
+                    row.update(culture_class=choices[0], culture_choice_1=choices[0],
+                               culture_choice_2=choices[1], culture_choice_3=choices[2])
+                if rnd.random() < self.donation_rate:
+                    row.update(donation=rnd.choice([20, 50, 100]), donation_check_num=3000+sid,
+                               donation_status=check_status)
+                writer.writerow(row.values())
+        return sid
+
+def write_arrangement(fh, nlines, seed=0, first=date(2015, 9, 12)):
+    '''write a synthetic constraint file of about nlines lines assigning the loaded students
+    to weekly AM/PM duties, return # of lines written'''
+    rnd = random.Random(seed)
+    pools = {'AM': [], 'PM': []}
+    for s in sorted(Student.all(), key=lambda s: s.id):
+        if s.isActive() and s.pod and s.cls.ampm() in pools:
+            pools[s.cls.ampm()].append(s)
+    for pool in pools.values(): rnd.shuffle(pool)
+
+    lines = ['#AM=4,6', '#PM=2,4', '#PJ=25', '']
+    day = first
+    while len(lines) < nlines and (pools['AM'] or pools['PM']):
+        for name, n in [('AM', 5), ('PM', 3)]:
+            lines += ['@%s' % day, '#%s' % name]
+            lines += [str(pools[name].pop()) for i in range(min(n, len(pools[name])))]
+            lines.append('')
+        day += timedelta(days=7)
+    fh.write('\n'.join(lines) + '\n')
+    return len(lines)
+
+def write_open_arrangement(fh, ndates, first=date(2015, 9, 12), pj_every=6, am='0,1000', pm='0,1000', pj='5'):
+    '''write a constraint file with ndates weekly dates of open AM/PM duties and a PJ duty every pj_every dates'''
+    print >> fh, '#AM=%s\n#PM=%s\n#PJ=%s\n' % (am, pm, pj)
+    day = first
+    for i in range(ndates):
+        print >> fh, '@%s\n#AM\n\n@%s\n#PM\n' % (day, day)
+        if i % pj_every == 0: print >> fh, '@%s\n#PJ\n' % day
+        day += timedelta(days=7)
+
+def usage():
+    print \
+        '''%s --csv <output csv> [--families <n>] [--seed <n>] [--children <n,n,...>] [--mix <kind=weight,...>]
+        [--am-rate <r>] [--withdraw-rate <r>] [--pending-rate <r>] [--check-pending-rate <r>] [--exempt-rate <r>]
+        [--culture-rate <r>] [--donation-rate <r>] [--cst <output cst> [--dates <n>] [--lines <n>]]
+        --csv,      write a synthetic registration csv, default 11000 families
+        --children, the # of children of a family is drawn from this list, default 1,1,2,2,3
+        --mix,      weights of the class kinds K/B/C/AP/AA, default K=2,B=18,C=10,AP=2,AA=1
+        --*-rate,   share of the registrations, between 0 and 1
+        --cst,      also write a constraint file of --dates open weekly dates (default 30),
+                    or with --lines, of about that many lines of duties assigned to the generated students''' % sys.argv[0]
+
+def main():
+    rates = ['am-rate', 'withdraw-rate', 'pending-rate', 'check-pending-rate', 'exempt-rate', 'culture-rate', 'donation-rate']
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                ['csv=', 'cst=', 'families=', 'seed=', 'children=', 'mix=', 'dates=', 'lines=', 'help'] + [r+'=' for r in rates])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile = cstfile = nlines = None
+    ndates = 30
+    school = School()
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--cst':
+            cstfile = v
+        elif o == '--families':
+            school.families = int(v)
+        elif o == '--seed':
+            school.seed = int(v)
+        elif o == '--children':
+            school.children = [int(n) for n in v.split(',')]
+        elif o == '--mix':
+            school.mix = OrderedDict((kind, float(w)) for kind, w in (kw.split('=') for kw in v.split(',')))
+            unknown = [kind for kind in school.mix if kind not in _class_kinds]
+            if unknown:
+                print >> sys.stderr, 'Unknown class kind %s' % ','.join(unknown)
+                sys.exit(1)
+        elif o == '--dates':
+            ndates = int(v)
+        elif o == '--lines':
+            nlines = int(v)
+        elif o[2:] in rates:
+            setattr(school, o[2:].replace('-', '_'), float(v))
+
+    if csvfile is None:
+        print >> sys.stderr, 'Missing output csv'
+        usage()
+        sys.exit(1)
+
+    with open(csvfile, 'wb') as fh:
+        nrows = school.write_registration(fh)
+    print '%s: %d families, %d registrations' % (csvfile, school.families, nrows)
+    if cstfile:
+        with open(cstfile, 'wt') as fh:
+            if nlines:
+                ccl.init(csvfile, needs=[])
+                print '%s: %d lines' % (cstfile, write_arrangement(fh, nlines, school.seed))
+            else:
+                write_open_arrangement(fh, ndates)
+                print '%s: %d open dates' % (cstfile, ndates)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# data quality rules over the loaded CCL tables
+#
+# Each rule checks one object of a table (student, parent or class).  validate() walks every
+# table once and applies all its rules to each object, so the cost is linear in the size of the
+# roster whatever the # of rules.  Rules needing other rows look them up in the indexes of ccl.
+# A rule is a factory called once per run, returning the check of one object: a message, or
+# None if the object passes.  Rows the loader rejects, e.g. a Received check without a check
+# number, are reported as load-error.
+import getopt, sys, re
+from collections import OrderedDict, namedtuple, defaultdict
+import ccl
+from ccl import *
+
+# rule: name of the rule, subject: the student/parent/class, or the csv line # of a load error
+Finding = namedtuple('Finding', ['rule', 'subject', 'message'])
+
+_phone_re = re.compile(r'^(\+?1[\s.-]*)?\(?\d{3}\)?[\s.-]*\d{3}[\s.-]*\d{4}(\s*(x|ext\.?)\s*\d+)?$')
+_email_re = re.compile(r'^[^@\s,;]+@[^@\s,;]+\.[A-Za-z]{2,}$')
+
+def _duplicate_student():
+    # Student.add() merges the rows of an ID, the last row sets cls and culture but the classes
+    # of the rows before still list the student
+    classes = defaultdict(list)   # student ==> classes listing it
+    for cls in Class.all():
+        for s in cls.students: classes[s].append(cls)
+    def check(s):
+        extra = [cls.name for cls in classes[s] if cls is not s.cls and cls is not s.culture]
+        if extra: return 'ID registered more than once, also in %s' % ', '.join(sorted(extra))
+    return check
+
+def _no_class():
+    def check(s):
+        if not s.cls.name: return 'no class'
+    return check
+
+def _aa_parent_pod():
+    aa = set(s.name for cls in Class.all() if cls.isAdultClass() for s in cls.students if s.isActive())
+    def check(s):
+        if not s.isActive() or not s.pod or s.parent is None: return None
+        names = [name for name in s.parent.key if name and name in aa]
+        if names: return 'parent %s is an AA student, please exempt from POD' % ' and '.join(names)
+    return check
+
+def _chinese_name():
+    def check(s):
+        if not s.chinesename: return None
+        try:
+            s.chinesename.decode('utf-8')
+        except UnicodeDecodeError:
+            return 'Chinese name %r is not utf-8' % s.chinesename
+    return check
+
+def _single_word_name():
+    def check(s):
+        if ' ' not in s.name: return 'name "%s" has no first and last name' % s.name
+    return check
+
+def _bad_phone():
+    def check(p):
+        bad = [phone for phone in p.phones if not _phone_re.match(phone)]
+        if bad: return 'bad phone %s' % ', '.join(sorted(bad))
+    return check
+
+def _bad_email():
+    def check(p):
+        bad = [email for email in p.emails if not _email_re.match(email)]
+        if bad: return 'bad email %s' % ', '.join(sorted(bad))
+    return check
+
+def _no_contact():
+    def check(p):
+        if not p.phones and not p.emails and any(s.isActive() for s in p.children): return 'no phone and no email'
+    return check
+
+def _bad_class_name():
+    def check(cls):
+        if cls.info.kind == "language" and cls.info.grade is None: return 'unrecognized grade'
+        # culture is the kind of any name not parsed, a class of the Class column must be parsed
+        if cls.info.kind == "culture" and any(s.cls is cls for s in cls.students):
+            return 'not a language class name'
+    return check
+
+# name ==> (table, rule factory, description), add to this to check more
+rules = OrderedDict([
+    ('duplicate-student',    ('student', _duplicate_student,    'a student ID in more than one class row')),
+    ('no-class',             ('student', _no_class,             'students with a blank Class cell')),
+    ('aa-parent-pod',        ('student', _aa_parent_pod,        'POD duty of a child whose parent is an AA student')),
+    ('chinese-name',         ('student', _chinese_name,         'Chinese names that are not utf-8')),
+    ('single-word-name',     ('student', _single_word_name,     'student names without first and last name')),
+    ('bad-phone',            ('parent',  _bad_phone,            'malformed phone numbers')),
+    ('bad-email',            ('parent',  _bad_email,            'malformed email addresses')),
+    ('no-contact',           ('parent',  _no_contact,           'families without phone and email')),
+    ('bad-class-name',       ('class',   _bad_class_name,        'class names that can not be parsed')),
+])
+
+def validate(names=None, errors=()):
+    '''run the rules (default all) over the loaded tables, return [Finding]
+
+    errors: RegistrationError of the rows skipped by ccl.init(), reported as "load-error"'''
+    if names is None: names = rules.keys()
+    unknown = [name for name in names if name not in rules]
+    if unknown: raise KeyError(', '.join(unknown))
+
+    findings = [Finding('load-error', err.lineno, err.message) for err in errors]
+    checks = defaultdict(list)   # table ==> [(name, check)]
+    for name in names:
+        table, factory, description = rules[name]
+        checks[table].append( (name, factory()) )
+    for table, objects in [('student', Student.all()), ('parent', Parent.all()), ('class', Class.all())]:
+        table_checks = checks[table]
+        if not table_checks: continue
+        for o in objects:
+            for name, check in table_checks:
+                message = check(o)
+                if message: findings.append(Finding(name, o, message))
+    return findings
+
+def write_report(fh, findings):
+    '''write the # of findings of each rule, then the findings rule by rule'''
+    by_rule = OrderedDict((name, []) for name in ['load-error'] + rules.keys())
+    for f in findings: by_rule[f.rule].append(f)
+    for name, fs in by_rule.iteritems():
+        if fs: print >> fh, '%-22s %6d' % (name, len(fs))
+    for name, fs in by_rule.iteritems():
+        if not fs: continue
+        print >> fh
+        print >> fh, '--- %s ---' % name
+        for f in fs:
+            subject = 'line %d' % f.subject if name == 'load-error' else repr(f.subject)
+            print >> fh, '%s: %s' % (subject, f.message)
+
+def usage():
+    print \
+        '''%s --csv <registration csv> [--rules <rule,...>]
+        --rules, only run these rules, default all:''' % sys.argv[0]
+    for name, (table, factory, description) in rules.iteritems():
+        print '            %-22s %s' % (name, description)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['csv=', 'rules=', 'help'])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(1)
+
+    csvfile, names = None, None
+    for o, v in opts:
+        if o in ['-h', '--help']:
+            usage()
+            sys.exit(0)
+        elif o == '--csv':
+            csvfile = v
+        elif o == '--rules':
+            names = v.split(',')
+
+    if csvfile is None:
+        print >> sys.stderr, 'Missing student registration csv'
+        usage()
+        sys.exit(1)
+
+    errors = ccl.init(csvfile, skip_errors=True)   # skip invalid rows instead of stopping at the first
+    try:
+        findings = validate(names, errors)
+    except KeyError as err:
+        print >> sys.stderr, 'Unknown rule %s' % err.args[0]
+        sys.exit(1)
+    write_report(sys.stdout, findings)
+    if findings: sys.exit(1)
+
+if __name__ == "__main__":
+    main()